@@ -1,17 +1,22 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, Response, stream_with_context, g
 from flask_cors import CORS
 import json
 from time import strftime
 from pymongo.mongo_client import MongoClient
-import requests  
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure
 import uuid
+import time
+import threading
+import sys
 import pytz
 import googlemaps
 import os
-from geopy.distance import geodesic
+import click
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage
-from vertexai.preview.generative_models import GenerativeModel
-from datetime import datetime
+from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
+from datetime import datetime, timedelta
 from linebot.v3 import (
     WebhookHandler
 )
@@ -35,27 +40,153 @@ from linebot.v3.webhooks import (
     LocationMessageContent
 )
 from utils import (
+    WeatherSnapshotStore,
+    FlexTemplate,
     get_nearest_station,
-    calculate_distance_matrix,
-    extract_distances,
+    DistanceMatrixCache,
+    build_distance_matrix,
     find_best_route,
-    get_places_by_city,
-    filter_high_rated_places,
-    is_nearby
+    PlaceCatalog,
+    TAIWAN_CITIES,
+    PLACE_CATALOG_REFRESH_SECONDS,
+    is_nearby,
+    NEARBY_DEFAULT_RADIUS_KM,
+    NEARBY_MAX_RADIUS_KM,
+    NEARBY_DEFAULT_LIMIT,
+    NEARBY_MAX_LIMIT,
+    ensure_place_location_indexes,
+    sync_place_locations,
+    find_nearby_places_indexed,
+    find_nearby_places_in_memory,
+    swap_adjacent_places_pipeline,
+    remove_place_pipeline,
+    set_day_pipeline,
+    remove_last_day_pipeline,
+    with_version_bump,
+    version_condition,
+    sync_version_datetime,
+    sync_version_pipeline,
+    apply_itinerary_operations,
+    ITINERARY_BATCH_MAX_OPERATIONS,
+    upload_photos,
+    gcs_public_url,
+    safe_photo_filename,
+    generate_upload_url,
+    existing_blob_names,
+    SIGNED_UPLOAD_EXPIRES_SECONDS,
+    schedule_photo_variants,
+    attach_display_photos,
+    GcsDeleteOutbox,
+    checkin_blob_names,
+    blob_name_from_url,
+    RecommendationCache,
+    RECOMMENDATION_POOL_SIZE,
+    RECOMMENDATION_CACHE_TTL_SECONDS,
+    RECOMMENDATION_CACHE_MAX_KEYS,
+    RECOMMENDATION_RESPONSE_SCHEMA,
+    compact_recommendation_prompt,
+    rehydrate_selection,
+    gemini_usage_summary,
+    PipelineError,
+    StageRunner,
+    sse_event,
+    WebhookEventDeduper,
+    reply_token_expired,
+    REPLY_TOKEN_TTL_SECONDS,
+    http_session,
+    configure_http_session,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_POOL_CONNECTIONS,
+    HTTP_POOL_MAXSIZE,
+    PlaceDetailsCache,
+    PLACE_DETAILS_CACHE_TTL_SECONDS,
+    PLACE_DETAILS_CACHE_MAX_ENTRIES,
+    PLACE_DETAILS_MAX_BATCH,
+    ensure_collection_indexes,
+    find_collscans,
+    itinerary_place_ids,
+    CHECKIN_PAGE_DEFAULT_LIMIT,
+    CHECKIN_PAGE_MAX_LIMIT,
+    checkin_document,
+    parse_time_filter,
+    encode_checkin_cursor,
+    decode_checkin_cursor,
+    checkin_page_query,
+    checkin_projection,
+    public_checkin,
+    metrics,
+    MongoCommandMetrics
 )
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# ---------------------------------------------------------------      指標
+# 以路由樣板（例如 /api/checkin/<checkin_id>）當標籤，避免每個 ID 各自成為一組指標
+def metrics_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    g.metrics_recorded = False
+    metrics.requests_in_flight.inc(route=metrics_route())
+
+@app.after_request
+def record_request_metrics(response):
+    route = metrics_route()
+    metrics.request_duration.observe(
+        time.perf_counter() - g.metrics_started,
+        method=request.method, route=route, status=f"{response.status_code // 100}xx"
+    )
+    if response.status_code >= 500:
+        metrics.request_errors.inc(method=request.method, route=route)
+    g.metrics_recorded = True
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    if 'metrics_started' not in g:
+        return
+    route = metrics_route()
+    if not g.metrics_recorded:
+        # 未處理的例外不會經過 after_request
+        metrics.request_duration.observe(time.perf_counter() - g.metrics_started, method=request.method, route=route, status='5xx')
+        metrics.request_errors.inc(method=request.method, route=route)
+    metrics.requests_in_flight.dec(route=route)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # 讀取環境變數
 with open('env.json') as f:
     env = json.load(f)
 
+# 對外 HTTP 的逾時與連線池大小，可在 env.json 的 HTTP 區塊覆寫
+http_options = {
+    "connect_timeout": HTTP_CONNECT_TIMEOUT,
+    "read_timeout": HTTP_READ_TIMEOUT,
+    "pool_connections": HTTP_POOL_CONNECTIONS,
+    "pool_maxsize": HTTP_POOL_MAXSIZE,
+    **env.get('HTTP', {})
+}
+configure_http_session(http_session, **http_options)
+http_timeout = (http_options['connect_timeout'], http_options['read_timeout'])
+
 configuration = Configuration(access_token=env['CHANNEL_ACCESS_TOKEN'])
+configuration.connection_pool_maxsize = http_options['pool_maxsize']
+# 整個程序共用一個 LINE API 客戶端，webhook 背景執行緒共用同一組 keep-alive 連線
+line_api_client = ApiClient(configuration)
+line_bot_api = MessagingApi(line_api_client)
 handler = WebhookHandler(env['CHANNEL_SECRET'])
 
 api_key = env['API_KEY']
 weather_url = f"https://opendata.cwa.gov.tw/api/v1/rest/datastore/O-A0001-001?Authorization={api_key}"
+# 天氣資料由背景執行緒定時更新，收到位置訊息時直接查詢記憶體中的快照
+weather_store = WeatherSnapshotStore(weather_url, env.get('WEATHER_CACHE_PATH', 'weather_snapshot.json'))
+weather_store.start()
 
 icon_base_url = "https://storage.googleapis.com/funtravelmap/weather_icon/"
 weather_icons = {
@@ -67,9 +198,11 @@ weather_icons = {
     "陰有雨": "rain_cloudy.png",
     "陰有雷雨": "rain_thunder.png"
 }
+# 天氣 Flex 樣板只載入並編譯一次，檔案修改後會自動重新載入
+weather_flex_template = FlexTemplate('flex_message_template.json')
 
 # 設置 MongoDB 連接
-mongo_client = MongoClient(env['MONGODB_URI'])
+mongo_client = MongoClient(env['MONGODB_URI'], event_listeners=[MongoCommandMetrics(metrics)])
 
 try:
     mongo_client.admin.command('ping')
@@ -79,28 +212,505 @@ except Exception as e:
 
 db = mongo_client['web']
 users = db['travel']
+# 行程獨立存放，以 itinerary_id 與 user_id 建索引，不再內嵌於使用者文件
+itineraries = db['itineraries']
+# 所有舊的內嵌行程都搬移完成後可設為 true，跳過舊資料的檢查
+legacy_itineraries_migrated = env.get('ITINERARIES_MIGRATED', False)
+place_ids_backfilled = env.get('PLACE_IDS_BACKFILLED', False)
+# 打卡獨立存放於 checkins 集合，不再內嵌於使用者文件，避免使用者文件持續變大
+checkins = db['checkins']
+legacy_checkins_migrated = env.get('CHECKINS_MIGRATED', False)
+# 刪除的行程留下墓碑紀錄，差異同步時告訴前端哪些行程已不存在
+itinerary_tombstones = db['itinerary_tombstones']
+# 景點兩兩之間的距離快取，避免重複向 Google Distance Matrix 查詢
+distance_cache = DistanceMatrixCache(db['distance_cache'])
+# 已存景點的 GeoJSON 鏡像，供附近景點查詢使用 2dsphere 索引
+place_locations = db['place_locations']
+use_place_geo_index = env.get('PLACE_GEO_INDEX', True)
 GOOGLE_MAPS_API_KEY = env['GOOGLE_MAPS_API_KEY']
 
 # Google Maps API 金鑰
 API_KEY = GOOGLE_MAPS_API_KEY
 # 初始化 googlemaps 客戶端
-gmaps = googlemaps.Client(key=API_KEY)
+gmaps = googlemaps.Client(
+    key=API_KEY,
+    connect_timeout=http_options['connect_timeout'],
+    read_timeout=http_options['read_timeout'],
+    requests_session=http_session
+)
+gmaps.places = metrics.instrument(gmaps.places, 'google_places', 'places')
+# 縣市景點目錄，智能推薦直接讀 MongoDB，不再每次即時分頁搜尋
+place_catalog = PlaceCatalog(
+    db['place_catalog'],
+    db['place_catalog_meta'],
+    gmaps,
+    refresh_seconds=env.get('PLACE_CATALOG_REFRESH_SECONDS', PLACE_CATALOG_REFRESH_SECONDS)
+)
 # 設置Google Application Credentials環境變量
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = 'teamwork.json'
 # 初始化Gemini模型
 model = GenerativeModel("gemini-1.5-pro-preview-0409")
+model.generate_content = metrics.instrument(model.generate_content, 'gemini', 'generate_content')
 # 設定生成配置
 generation_config = {
     "temperature": 1,
     "top_k": 40,
     "top_p": 0.9
 }
+# 智能推薦的 Gemini 結果快取，池子大小、TTL 與最大鍵數可在 env.json 設定
+recommendation_cache = RecommendationCache(
+    pool_size=env.get('RECOMMENDATION_POOL_SIZE', RECOMMENDATION_POOL_SIZE),
+    ttl_seconds=env.get('RECOMMENDATION_CACHE_TTL_SECONDS', RECOMMENDATION_CACHE_TTL_SECONDS),
+    max_keys=env.get('RECOMMENDATION_CACHE_MAX_KEYS', RECOMMENDATION_CACHE_MAX_KEYS)
+)
+
+# 智能推薦只要求模型回傳候選編號陣列，輸出 token 少且不會因為回傳格式錯亂而解析失敗
+recommendation_generation_config = GenerationConfig(
+    **generation_config,
+    response_mime_type='application/json',
+    response_schema=RECOMMENDATION_RESPONSE_SCHEMA
+)
+# 在 env.json 設定 GEMINI_MEASURE 為 true 時，記錄每次呼叫的 token 數與生成時間
+gemini_measure = env.get('GEMINI_MEASURE', False)
+
+def select_places_with_gemini(places_list):
+    # 回傳 (Gemini 挑選的景點, 錯誤訊息)
+    prompt = compact_recommendation_prompt(places_list)
+    started = time.perf_counter()
+    r = model.generate_content(
+        [prompt],
+        generation_config=recommendation_generation_config
+    )
+    if gemini_measure:
+        print(f"Gemini 推薦用量: {gemini_usage_summary(r, time.perf_counter() - started)}")
+
+    # 從候選清單還原模型挑選的景點
+    print("處理 Gemini 回應")
+    if not isinstance(r.text, str):
+        return None, 'Gemini API 回應格式錯誤'
+    try:
+        return rehydrate_selection(r.text.strip(), places_list), None
+    except (json.JSONDecodeError, ValueError):
+        return None, 'Gemini 回應無效的 JSON'
 
 # 設置Google Cloud Storage客戶端
 # os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "gcs-key.json"
+# 本機測試時可在 env.json 設定 STORAGE_EMULATOR_HOST 指向 GCS 模擬器
+if env.get('STORAGE_EMULATOR_HOST'):
+    os.environ['STORAGE_EMULATOR_HOST'] = env['STORAGE_EMULATOR_HOST']
 gcs_client = storage.Client()
 bucket_name = 'funtravelmap' # 你的存儲桶名稱
 bucket = gcs_client.bucket(bucket_name)
+MAX_CHECKIN_PHOTOS = 9  # 每筆打卡最多的照片數量
+# 照片刪除改為寫入 outbox，由背景執行緒批次刪除 GCS 物件
+gcs_delete_outbox = GcsDeleteOutbox(db['gcs_delete_outbox'], gcs_client, bucket)
+gcs_delete_outbox.start()
+
+def record_photo_variants(checkin_id):
+    # 縮圖產生後寫回打卡的 photo_variants，與 photos 中的原圖網址一一對應
+    # 原圖在縮圖完成前已被刪除時不寫入，改把縮圖排入刪除佇列，避免留下沒有紀錄的物件
+    def record(photo_url, variants):
+        result = checkins.update_one(
+            {"_id": checkin_id, "photos": photo_url},
+            {"$push": {"photo_variants": {"url": photo_url, "variants": variants}}}
+        )
+        if result.matched_count == 0:
+            gcs_delete_outbox.enqueue([blob_name_from_url(bucket_name, variant['url']) for variant in variants])
+    return record
+
+def photo_limit_condition(count):
+    # 加入 count 張照片後仍不超過上限：第 MAX_CHECKIN_PHOTOS - count + 1 張不存在
+    return {f"photos.{MAX_CHECKIN_PHOTOS - count}": {"$exists": False}}
+
+def parse_photo_view_options(data):
+    # 前端可指定顯示寬度與偏好格式，回傳最適合的縮圖
+    try:
+        view_width = int(data.get('viewWidth')) if data.get('viewWidth') else None
+    except (TypeError, ValueError):
+        view_width = None
+    preferred_format = data.get('format') if data.get('format') in ('webp', 'jpeg') else 'webp'
+    return view_width, preferred_format
+
+def migrate_user_itineraries(user_id):
+    # 把使用者文件內嵌的行程搬到 itineraries 集合，已搬過的行程不會被覆蓋
+    if legacy_itineraries_migrated:
+        return 0
+    user = users.find_one({"_id": user_id, "itineraries.0": {"$exists": True}}, {"itineraries": 1})
+    if not user:
+        return 0
+    operations = []
+    for itinerary in user['itineraries']:
+        fields = {k: v for k, v in itinerary.items() if k != 'itinerary_id'}
+        fields['user_id'] = user_id
+        fields.setdefault('version', 0)
+        fields['place_ids'] = itinerary_place_ids(itinerary)
+        operations.append(UpdateOne(
+            {"itinerary_id": itinerary['itinerary_id']},
+            {"$setOnInsert": fields, "$currentDate": {"user_version": True}},
+            upsert=True
+        ))
+    itineraries.bulk_write(operations, ordered=True)  # 依序寫入，_id 順序與原本行程順序一致
+    users.update_one(
+        {"_id": user_id},
+        {"$pull": {"itineraries": {"itinerary_id": {"$in": [it['itinerary_id'] for it in user['itineraries']]}}}}
+    )
+    # 搬過來的行程也要建立 place_locations 鏡像，附近景點查詢才找得到
+    for itinerary in user['itineraries']:
+        refresh_itinerary_locations(itinerary['itinerary_id'])
+    return len(operations)
+
+def find_itinerary(itinerary_id, projection=None):
+    # 先查新集合，找不到時檢查是否還留在舊的使用者文件中，有的話先搬移再查
+    projection = projection or {"_id": 0}
+    itinerary = itineraries.find_one({"itinerary_id": itinerary_id}, projection)
+    if itinerary or legacy_itineraries_migrated:
+        return itinerary
+    legacy_user = users.find_one({"itineraries.itinerary_id": itinerary_id}, {"_id": 1})
+    if not legacy_user:
+        return None
+    migrate_user_itineraries(legacy_user['_id'])
+    return itineraries.find_one({"itinerary_id": itinerary_id}, projection)
+
+def migrate_user_checkins(user_id):
+    # 把使用者文件內嵌的打卡搬到 checkins 集合，$setOnInsert 讓重複執行不會覆蓋已搬移的資料
+    if legacy_checkins_migrated:
+        return 0
+    user = users.find_one({"_id": user_id, "checkins.0": {"$exists": True}}, {"checkins": 1})
+    if not user:
+        return 0
+    operations = []
+    checkin_ids = []
+    for record in user['checkins']:
+        if not record.get('checkinId'):
+            continue
+        doc = checkin_document(user_id, record)
+        operations.append(UpdateOne(
+            {"_id": doc.pop('_id')},
+            {"$setOnInsert": doc},
+            upsert=True
+        ))
+        checkin_ids.append(record['checkinId'])
+    if operations:
+        checkins.bulk_write(operations, ordered=False)
+    users.update_one(
+        {"_id": user_id},
+        {"$pull": {"checkins": {"checkinId": {"$in": checkin_ids}}}}
+    )
+    return len(operations)
+
+def find_checkin(checkin_id, projection=None):
+    # 先查 checkins 集合，找不到時檢查是否還內嵌在使用者文件中，有的話先搬移再查
+    checkin = checkins.find_one({"_id": checkin_id}, projection)
+    if checkin or legacy_checkins_migrated:
+        return checkin
+    legacy_user = users.find_one({"checkins.checkinId": checkin_id}, {"_id": 1})
+    if not legacy_user:
+        return None
+    migrate_user_checkins(legacy_user['_id'])
+    return checkins.find_one({"_id": checkin_id}, projection)
+
+def update_itinerary(itinerary_id, update, conditions=None, version=None, invalid_message='參數無效'):
+    # 一次 find_one_and_update 完成修改並遞增 version，回傳 (新版本號, 錯誤回應)
+    # 有帶 version 時作為樂觀鎖，版本不符代表其他裝置已修改過這個行程
+    query = {"itinerary_id": itinerary_id}
+    query.update(conditions or {})
+    if version is not None:
+        query["version"] = version_condition(version)
+    update = with_version_bump(update)
+
+    for attempt in range(2):
+        result = itineraries.find_one_and_update(
+            query, update,
+            projection={"_id": 0, "version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if result:
+            return result['version'], None
+        if attempt == 1:
+            break
+        # 只有失敗時才多讀一次，判斷是找不到、版本衝突還是條件不符（舊資料剛搬移則重試一次）
+        current = find_itinerary(itinerary_id, {"_id": 0, "version": 1})
+        if not current:
+            return None, (jsonify({'status': 'error', 'message': '找不到行程'}), 404)
+        current_version = current.get('version', 0)
+        if version is not None and current_version != version:
+            return None, (jsonify({'status': 'error', 'message': '行程已在其他地方被修改，請重新整理', 'version': current_version}), 409)
+    return None, (jsonify({'status': 'error', 'message': invalid_message}), 400)
+
+@app.cli.command('migrate-itineraries')
+@click.option('--batch-size', default=100, help='每批處理的使用者數量')
+def migrate_itineraries_command(batch_size):
+    # 線上搬移所有內嵌行程：flask --app lineweb migrate-itineraries
+    # 服務不需停機，搬移期間的讀寫會透過 find_itinerary / migrate_user_itineraries 自動補搬
+    last_id = None
+    total_users = total_itineraries = 0
+    while True:
+        query = {"itineraries.0": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(users.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        for user in batch:
+            total_itineraries += migrate_user_itineraries(user['_id'])
+        total_users += len(batch)
+        last_id = batch[-1]['_id']
+        print(f"已搬移 {total_users} 位使用者，共 {total_itineraries} 個行程")
+    print("行程搬移完成")
+
+@app.cli.command('migrate-checkins')
+@click.option('--batch-size', default=100, help='每批處理的使用者數量')
+def migrate_checkins_command(batch_size):
+    # 線上搬移所有內嵌打卡：flask --app lineweb migrate-checkins
+    # 服務不需停機，搬移期間的讀寫會透過 find_checkin / migrate_user_checkins 自動補搬
+    last_id = None
+    total_users = total_checkins = 0
+    while True:
+        query = {"checkins.0": {"$exists": True}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(users.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        for user in batch:
+            total_checkins += migrate_user_checkins(user['_id'])
+        total_users += len(batch)
+        last_id = batch[-1]['_id']
+        print(f"已搬移 {total_users} 位使用者，共 {total_checkins} 筆打卡")
+    print("打卡搬移完成")
+
+# 景點座標鏡像在背景更新，行程修改的請求只需一次資料庫往返
+location_sync_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='location-sync')
+# 同一個行程的同步依序執行，後執行的一定讀到最新的行程，不會被較舊的結果蓋掉
+location_sync_locks = [threading.Lock() for _ in range(64)]
+
+def sync_itinerary_place_ids(itinerary):
+    # 行程的寫入端已在同一次更新中維護 place_ids，這裡只補上舊資料或修正不一致的結果
+    # 只在版本沒變時寫入，避免較舊的同步覆蓋掉較新的結果；版本已變時重新讀取再試
+    for _ in range(3):
+        place_ids = itinerary_place_ids(itinerary)
+        current = itinerary.get('place_ids')
+        if current is not None and set(current) == set(place_ids):
+            return
+        result = itineraries.update_one(
+            {"itinerary_id": itinerary['itinerary_id'], "version": itinerary.get('version')},
+            {"$set": {"place_ids": place_ids}}
+        )
+        if result.matched_count:
+            return
+        itinerary = itineraries.find_one(
+            {"itinerary_id": itinerary['itinerary_id']},
+            {"_id": 0, "itinerary_id": 1, "places": 1, "place_ids": 1, "version": 1}
+        )
+        if not itinerary:
+            return
+
+def backfill_user_place_ids(user_id):
+    # 還沒有 place_ids 欄位的舊行程先補上，全部回填完成後可在 env.json 設定 PLACE_IDS_BACKFILLED 跳過
+    if place_ids_backfilled:
+        return
+    for itinerary in itineraries.find({"user_id": user_id, "place_ids": {"$exists": False}}, {"_id": 0}):
+        sync_itinerary_place_ids(itinerary)
+
+def _sync_itinerary_locations(itinerary_id):
+    try:
+        with location_sync_locks[hash(itinerary_id) % len(location_sync_locks)]:
+            itinerary = itineraries.find_one({"itinerary_id": itinerary_id}, {"_id": 0})
+            if itinerary:
+                sync_itinerary_place_ids(itinerary)
+                if use_place_geo_index:
+                    sync_place_locations(place_locations, itinerary['user_id'], itinerary)
+            elif use_place_geo_index:
+                place_locations.delete_many({"itinerary_id": itinerary_id})
+    except Exception as e:
+        print(f'同步景點座標時發生錯誤: {e}')
+
+def refresh_itinerary_locations(itinerary_id):
+    # 行程景點異動後在背景更新 place_ids 反查欄位與 place_locations 鏡像，失敗不影響原本的請求
+    location_sync_executor.submit(_sync_itinerary_locations, itinerary_id)
+
+def _sync_place_id_locations(user_id, place_id):
+    for itinerary in itineraries.find({"user_id": user_id, "place_ids": place_id}, {"itinerary_id": 1}):
+        _sync_itinerary_locations(itinerary['itinerary_id'])
+
+def refresh_place_id_locations(user_id, place_id):
+    # 打卡標記 visited 會同時影響多個行程，背景重建含有該景點的行程鏡像
+    if use_place_geo_index:
+        location_sync_executor.submit(_sync_place_id_locations, user_id, place_id)
+
+@app.cli.command('sync-place-locations')
+def sync_all_place_locations():
+    # 回填所有行程的 place_ids 與景點座標鏡像：flask --app lineweb sync-place-locations
+    count = 0
+    for itinerary in itineraries.find({}, {"_id": 0}):
+        sync_itinerary_place_ids(itinerary)
+        if use_place_geo_index:
+            sync_place_locations(place_locations, itinerary['user_id'], itinerary)
+        count += 1
+    print(f"已同步 {count} 個行程的景點座標")
+
+@app.cli.command('prewarm-catalog')
+@click.option('--city', 'cities', multiple=True, help='只預熱指定縣市，可重複指定；預設為全台縣市')
+@click.option('--place-type', default='tourist_attraction', help='景點類型')
+def prewarm_catalog_command(cities, place_type):
+    # 預熱縣市景點目錄：flask --app lineweb prewarm-catalog
+    for city_name in cities or TAIWAN_CITIES:
+        try:
+            places = place_catalog.refresh(city_name, place_type)
+            print(f"{city_name}: {len(places)} 個景點")
+        except Exception as e:
+            print(f"{city_name} 預熱失敗: {e}")
+    print("景點目錄預熱完成")
+
+# webhook 只在請求內驗證簽章，事件交給背景執行緒處理，讓 LINE 立即收到 200
+webhook_workers = env.get('WEBHOOK_WORKERS', 8)
+webhook_executor = ThreadPoolExecutor(max_workers=webhook_workers, thread_name_prefix='webhook')
+# 排隊中的事件上限，滿了就在請求執行緒內直接處理，避免無限堆積
+webhook_slots = threading.BoundedSemaphore(env.get('WEBHOOK_MAX_PENDING', webhook_workers * 4))
+webhook_deduper = WebhookEventDeduper(db['webhook_events'])
+reply_token_ttl = env.get('REPLY_TOKEN_TTL_SECONDS', REPLY_TOKEN_TTL_SECONDS)
+
+# ---------------------------------------------------------------      MongoDB 索引
+# 所有熱門查詢需要的索引集中在這裡宣告；啟動時與 flask --app lineweb ensure-indexes 都會建立
+# 打卡以使用者與時間分頁查詢；舊的內嵌打卡與行程以 checkins.checkinId、itineraries.itinerary_id 查詢
+INDEXES = {
+    itineraries: [
+        ("itinerary_id", {"unique": True}),
+        ([("user_id", 1), ("_id", 1)], {}),
+        ([("user_id", 1), ("place_ids", 1)], {}),
+        ([("user_id", 1), ("user_version", 1)], {}),
+    ],
+    itinerary_tombstones: [
+        ([("user_id", 1), ("user_version", 1)], {}),
+    ],
+    users: [
+        ("checkins.checkinId", {}),
+        ("itineraries.itinerary_id", {"sparse": True}),
+    ],
+    checkins: [
+        ([("user_id", 1), ("ts", 1), ("_id", 1)], {}),
+    ],
+}
+
+def ensure_all_indexes():
+    for collection, specs in INDEXES.items():
+        ensure_collection_indexes(collection, specs)
+    distance_cache.ensure_indexes()
+    place_catalog.ensure_indexes()
+    gcs_delete_outbox.ensure_indexes()
+    webhook_deduper.ensure_indexes()
+    if use_place_geo_index:
+        ensure_place_location_indexes(place_locations)
+
+if env.get('ENSURE_INDEXES_ON_STARTUP', True):
+    try:
+        ensure_all_indexes()
+    except Exception as e:
+        print(e)
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    # 建立所有索引：flask --app lineweb ensure-indexes
+    ensure_all_indexes()
+    print("索引建立完成")
+
+def query_plan_shapes():
+    # app 發出的每種查詢形狀，以範例值執行 explain()；全表掃描的 sync-place-locations 與搬移指令不列入
+    sample = "__explain__"
+    now = datetime.utcnow()
+    shapes = [
+        ("itineraries 依 itinerary_id", itineraries.find({"itinerary_id": sample})),
+        ("itineraries 版本條件更新", itineraries.find({"itinerary_id": sample, "version": 0})),
+        ("itineraries 依使用者列出", itineraries.find({"user_id": sample}).sort("_id", 1)),
+        ("itineraries 差異同步", itineraries.find({"user_id": sample, "user_version": {"$gt": now}}).sort("_id", 1)),
+        ("itineraries 同步版本", itineraries.find({"user_id": sample}).sort("user_version", -1).limit(1)),
+        ("itinerary_tombstones 差異同步", itinerary_tombstones.find({"user_id": sample, "user_version": {"$gt": now}})),
+        ("itinerary_tombstones 同步版本", itinerary_tombstones.find({"user_id": sample}).sort("user_version", -1).limit(1)),
+        ("itineraries 刪除", itineraries.find({"itinerary_id": sample, "user_id": sample})),
+        ("itineraries 依使用者與景點", itineraries.find({"user_id": sample, "place_ids": sample})),
+        ("itineraries 打卡連結", itineraries.find({"itinerary_id": {"$in": [sample]}, "place_ids": sample})),
+        ("travel 依使用者", users.find({"_id": sample})),
+        ("travel 舊的內嵌行程", users.find({"itineraries.itinerary_id": sample})),
+        ("travel 待搬移行程", users.find({"itineraries.0": {"$exists": True}}).sort("_id", 1)),
+        ("travel 依打卡 ID", users.find({"checkins.checkinId": sample})),
+        ("travel 待搬移打卡", users.find({"checkins.0": {"$exists": True}}).sort("_id", 1)),
+        ("checkins 依 ID", checkins.find({"_id": sample})),
+        ("checkins 依使用者分頁", checkins.find(checkin_page_query(sample, now - timedelta(days=30), now, (now, sample))).sort([("ts", 1), ("_id", 1)])),
+        ("distance_cache 批次查詢", distance_cache.collection.find({"_id": {"$in": [sample]}, "expires_at": {"$gt": now}})),
+        ("place_catalog 高評價景點", place_catalog.collection.find({"city": sample, "place_type": sample, "rating": {"$gte": 4.0}})),
+        ("place_catalog 清除舊景點", place_catalog.collection.find({"city": sample, "place_type": sample, "fetched_at": {"$lt": now}})),
+        ("place_catalog_meta 依 ID", place_catalog.meta_collection.find({"_id": sample})),
+        ("gcs_delete_outbox 待刪除", gcs_delete_outbox.collection.find({"next_attempt_at": {"$lte": now}})),
+        ("gcs_delete_outbox 租約", gcs_delete_outbox.collection.find({"_id": {"$in": [sample]}, "lease": sample})),
+        ("webhook_events 依 ID", webhook_deduper.collection.find({"_id": sample})),
+        ("place_locations 依行程", place_locations.find({"itinerary_id": sample})),
+    ]
+    return [(name, cursor.explain()) for name, cursor in shapes]
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    # 查詢計畫回歸檢查：flask --app lineweb check-query-plans，有任何 COLLSCAN 時以狀態碼 1 結束
+    failed = []
+    plans = query_plan_shapes()
+    if use_place_geo_index:
+        plans.append(("place_locations 附近景點", db.command(
+            'aggregate', place_locations.name,
+            pipeline=[{"$geoNear": {
+                "near": {"type": "Point", "coordinates": [121.5, 25.0]},
+                "key": "location",
+                "distanceField": "distance",
+                "query": {"user_id": "__explain__"},
+                "spherical": True
+            }}],
+            explain=True
+        )))
+    for name, explain in plans:
+        collscans = find_collscans(explain)
+        print(f"{'COLLSCAN' if collscans else 'OK':<8} {name}")
+        if collscans:
+            failed.append(name)
+    if failed:
+        print(f"{len(failed)} 個查詢會全表掃描")
+        sys.exit(1)
+    print("所有查詢都有使用索引")
+
+def find_event_handler(event):
+    # 與 WebhookHandler.handle 相同的查找順序：事件+訊息類型、事件類型、預設
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{type(event).__name__}_{type(event.message).__name__}")
+    return func or handler._handlers.get(type(event).__name__) or handler._default
+
+def process_webhook_event(event):
+    event_id = getattr(event, 'webhook_event_id', None)
+    try:
+        if not webhook_deduper.claim(event_id):
+            app.logger.info("Skip redelivered webhook event %s", event_id)
+            return
+        # 訊息事件只用來回覆，reply token 過期就不必再處理
+        if isinstance(event, MessageEvent) and reply_token_expired(event.timestamp, reply_token_ttl):
+            app.logger.warning("Reply token expired for webhook event %s", event_id)
+            return
+        func = find_event_handler(event)
+        if func is None:
+            app.logger.info("No handler for %s", type(event).__name__)
+            return
+        func(event)
+    except Exception as e:
+        print(f"Error in webhook event {event_id}: {e}")
+
+def dispatch_webhook_event(event):
+    if not webhook_slots.acquire(blocking=False):
+        process_webhook_event(event)
+        return
+
+    def run():
+        try:
+            process_webhook_event(event)
+        finally:
+            webhook_slots.release()
+
+    webhook_executor.submit(run)
 
 @app.route("/api/callback", methods=['POST'])
 def callback():
@@ -111,51 +721,50 @@ def callback():
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
 
-    # handle webhook body
+    # verify signature inline, handle events in the background
     try:
-        handler.handle(body, signature)
+        events = handler.parser.parse(body, signature)
     except InvalidSignatureError:
         app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
 
+    for event in events:
+        dispatch_webhook_event(event)
+
     return 'OK'
 
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                
-            )
-        )
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            
+        ),
+        _request_timeout=http_timeout
+    )
 
 @handler.add(FollowEvent)
 def handle_follow(event):
     userid = event.source.user_id
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        profile = line_bot_api.get_profile(userid)
-        existing_user = users.find_one({"_id": userid})
-
-        if not existing_user:
-            # insert into MongoDB
-            u = {
-                "_id": userid,
-                "display_name": profile.display_name,
-                "picture_url": profile.picture_url,
-                "status_message": profile.status_message,
-                "language": profile.language,
-                "follow": strftime('%Y/%m/%d-%H:%M:%S'),
-                "unfollow": None,
-                "itineraries": []
-            }
-            users.insert_one(u)
-        else:
-            users.update_one(
-                {"_id": userid},
-                {"$set": {"follow": strftime('%Y/%m/%d-%H:%M:%S'), "unfollow": None}}
-            )
+    profile = line_bot_api.get_profile(userid, _request_timeout=http_timeout)
+    existing_user = users.find_one({"_id": userid})
+
+    if not existing_user:
+        # insert into MongoDB
+        u = {
+            "_id": userid,
+            "display_name": profile.display_name,
+            "picture_url": profile.picture_url,
+            "status_message": profile.status_message,
+            "language": profile.language,
+            "follow": strftime('%Y/%m/%d-%H:%M:%S'),
+            "unfollow": None
+        }
+        users.insert_one(u)
+    else:
+        users.update_one(
+            {"_id": userid},
+            {"$set": {"follow": strftime('%Y/%m/%d-%H:%M:%S'), "unfollow": None}}
+        )
 
 @handler.add(UnfollowEvent)
 def handle_unfollow(event):
@@ -169,57 +778,84 @@ def handle_unfollow(event):
 def handle_location_message(event):
     latitude = event.message.latitude
     longitude = event.message.longitude
-    weather_info = get_nearest_station(latitude, longitude, weather_url)
+    weather_info = get_nearest_station(latitude, longitude, weather_store)
     
     if isinstance(weather_info, dict):
+        if weather_info['資料過期']:
+            app.logger.warning("Weather snapshot is stale, serving data fetched at %s", weather_info['更新時間'])
         weather = weather_info['天氣']
         icon_filename = weather_icons.get(weather, "default.png")
         icon_url = f"{icon_base_url}{icon_filename}"
 
-        with open('flex_message_template.json', encoding='utf-8') as f:
-            flex_template = json.load(f)
-
-        flex_template_str = json.dumps(flex_template)
-        flex_template_str = flex_template_str.replace("${city}", weather_info['縣市'])
-        flex_template_str = flex_template_str.replace("${town}", weather_info['鄉鎮'])
-        flex_template_str = flex_template_str.replace("${weather}", weather)
-        flex_template_str = flex_template_str.replace("${icon_url}", icon_url)
-        flex_template_str = flex_template_str.replace("${temperature}", str(weather_info['氣溫']))
-        flex_template_str = flex_template_str.replace("${rainfall}", str(weather_info['降雨量']))
-        flex_template = json.loads(flex_template_str)
+        flex_contents = weather_flex_template.render({
+            'city': weather_info['縣市'],
+            'town': weather_info['鄉鎮'],
+            'weather': weather,
+            'icon_url': icon_url,
+            'temperature': weather_info['氣溫'],
+            'rainfall': weather_info['降雨量']
+        })
 
         msg = FlexMessage(
-            alt_text="天氣資訊",
-            contents=FlexContainer.from_json(json.dumps(flex_template))
+            alt_text="天氣資訊（資料可能已過時）" if weather_info['資料過期'] else "天氣資訊",
+            contents=FlexContainer.from_dict(flex_contents)
         )
     else:
         msg = TextMessage(text=weather_info)
         
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
-        line_bot_api.reply_message_with_http_info(
-            ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[msg]
-            )
-        )
+    line_bot_api.reply_message_with_http_info(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[msg]
+        ),
+        _request_timeout=http_timeout
+    )
 
 # ---------------------------------------------------------------     weather
 
 @app.route('/api/get_itineraries', methods=['POST']) #-------------------------查看行程
 def get_itineraries():
+    # 回應帶 ETag 與 version；前端帶 If-None-Match 且沒有變動時回 304
+    # 帶 since_version 時只回傳之後修改過的行程與已刪除的行程 ID
     user_id = request.json.get('user_id')
+    since_version = request.json.get('since_version')
     
     if not user_id:
         return jsonify({'status': 'error', 'message': '需要提供使用者ID'}), 400
+    if since_version is not None and (not isinstance(since_version, int) or since_version < 0):
+        return jsonify({'status': 'error', 'message': 'since_version 必須是非負整數'}), 400
 
     try:
-        user = users.find_one({"_id": user_id})
+        user = users.find_one({"_id": user_id}, {"_id": 1})
         if not user:
             return jsonify({'status': 'error', 'message': '找不到使用者'}), 404
 
-        itineraries = user.get('itineraries', [])
-        return jsonify({'status': 'success', 'itineraries': itineraries})
+        # 版本只取已經可見的寫入，先算版本再讀行程，讀到的內容不會比版本舊
+        migrate_user_itineraries(user_id)
+        latest = next(itineraries.aggregate(sync_version_pipeline(user_id, itinerary_tombstones.name)), None)
+        current_version = max(latest['version'], 0) if latest else 0
+        etag = f'"{user_id}-{current_version}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            response = app.response_class(status=304)
+            response.headers['ETag'] = etag
+            return response
+
+        projection = {"_id": 0, "user_id": 0, "place_ids": 0, "user_version": 0}
+        if since_version is not None:
+            since = sync_version_datetime(since_version)
+            changed = list(itineraries.find(
+                {"user_id": user_id, "user_version": {"$gt": since}}, projection
+            ).sort("_id", 1))
+            deleted = [
+                tombstone['_id']
+                for tombstone in itinerary_tombstones.find({"user_id": user_id, "user_version": {"$gt": since}}, {"_id": 1})
+            ]
+            response = jsonify({'status': 'success', 'delta': True, 'itineraries': changed, 'deleted': deleted, 'version': current_version})
+        else:
+            user_itineraries = list(itineraries.find({"user_id": user_id}, projection).sort("_id", 1))
+            response = jsonify({'status': 'success', 'itineraries': user_itineraries, 'version': current_version})
+        response.headers['ETag'] = etag
+        return response
     except Exception as e:
         print(f'獲取使用者行程時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': f'獲取使用者行程時發生錯誤: {str(e)}'}), 500
@@ -247,20 +883,30 @@ def add_itinerary():
     # 初始化行程，每天的景點列表为空
     itinerary = {
         "itinerary_id": itinerary_id,
+        "user_id": user_id,
         "name": itinerary_name,
         "days": days,
-        "places": [[] for _ in range(days)]
+        "places": [[] for _ in range(days)],
+        "place_ids": [],
+        "version": 0
     }
-    # 更新用戶的行程列表，添加新的行程
-    result = users.update_one(
-        {"_id": user_id},
-        {"$push": {"itineraries": itinerary}}
-    )
+    # 使用者存在才新增行程
+    if not users.find_one({"_id": user_id}, {"_id": 1}):
+        return jsonify({'status': 'error', 'message': 'Failed to add itinerary'}), 500
 
-    # 檢查更新操作是否成功
-    if result.modified_count > 0:
+    try:
+        # 以 upsert 新增，user_version 才能使用伺服器時間；已存在同 ID 的行程時不覆蓋
+        result = itineraries.update_one(
+            {"itinerary_id": itinerary_id},
+            {"$setOnInsert": itinerary, "$currentDate": {"user_version": True}},
+            upsert=True
+        )
+        if result.upserted_id is None:
+            return jsonify({'status': 'error', 'message': 'Failed to add itinerary'}), 500
+        itinerary_tombstones.delete_one({"_id": itinerary_id})
         return jsonify({'status': 'success'})
-    else:
+    except Exception as e:
+        print(f'新增行程時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': 'Failed to add itinerary'}), 500
     
 @app.route('/api/delete_itinerary', methods=['POST']) #--------------------刪除行程
@@ -273,13 +919,20 @@ def delete_itinerary():
         return jsonify({'status': 'error', 'message': '需要提供使用者ID和行程ID'}), 400
 
     try:
-        user = users.find_one({"_id": user_id})
+        user = users.find_one({"_id": user_id}, {"_id": 1})
         if not user:
             return jsonify({'status': 'error', 'message': '找不到使用者'}), 404
 
-        # 找到並刪除對應的行程
-        updated_itineraries = [it for it in user.get('itineraries', []) if it['itinerary_id'] != itinerary_id]
-        users.update_one({"_id": user_id}, {"$set": {"itineraries": updated_itineraries}})
+        # 找到並刪除對應的行程，留下墓碑讓其他裝置差異同步時得知
+        migrate_user_itineraries(user_id)
+        result = itineraries.delete_one({"itinerary_id": itinerary_id, "user_id": user_id})
+        if result.deleted_count:
+            itinerary_tombstones.update_one(
+                {"_id": itinerary_id},
+                {"$set": {"user_id": user_id}, "$currentDate": {"user_version": True}},
+                upsert=True
+            )
+        refresh_itinerary_locations(itinerary_id)
         return jsonify({'status': 'success', 'message': '行程已刪除'})
     except Exception as e:
         print(f'刪除行程時發生錯誤: {e}')
@@ -291,37 +944,30 @@ def add_place():
     itinerary_id = data.get('itinerary_id')
     day_index = data.get('day_index')
     place = data.get('place')
+    position = data.get('position')  # 插入位置，未提供時加在當天最後
     if not itinerary_id or day_index is None or not place:
         return jsonify({'status': 'error', 'message': '缺少行程ID或地點信息或天數索引'}), 400
+    if day_index < 0 or (position is not None and position < 0):
+        return jsonify({'status': 'error', 'message': '天數索引無效'}), 400
     try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-        # 查找具體的行程
-        itinerary = None
-        for it in user['itineraries']:
-            if it['itinerary_id'] == itinerary_id:
-                itinerary = it
-                break
-        if not itinerary:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-        # 確保 'places' 是一個包含多個子數組的列表，每個子數組代表一天的行程
-        if not isinstance(itinerary['places'], list):
-            itinerary['places'] = []
-
-        # 初始化每一天的行程為一個列表
-        while len(itinerary['places']) <= day_index:
-            itinerary['places'].append([])
-
-        # 將新的地點添加到指定的天數
-        itinerary['places'][day_index].append(place)
-
-        # 更新 MongoDB 中的用戶文檔
-        users.update_one(
-            {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-            {"$set": {"itineraries.$.places": itinerary['places']}}
+        # 直接把地點推進指定天數的陣列，不必先讀出整份行程
+        push = {"$each": [place]}
+        if position is not None:
+            push["$position"] = position
+        update = {"$push": {f"places.{day_index}": push}}
+        if place.get('place_id'):
+            update["$addToSet"] = {"place_ids": place['place_id']}  # 與景點一起寫入，打卡立即找得到這個行程
+        version, error = update_itinerary(
+            itinerary_id,
+            update,
+            conditions={f"places.{day_index}": {"$type": "array"}},
+            version=data.get('version'),
+            invalid_message='天數索引無效'
         )
-        return jsonify({'status': 'success'}), 200
+        if error:
+            return error
+        refresh_itinerary_locations(itinerary_id)
+        return jsonify({'status': 'success', 'version': version}), 200
 
     except Exception as e:
         print(f'添加地點時發生錯誤: {e}')
@@ -336,19 +982,17 @@ def remove_day():
         return jsonify({'status': 'error', 'message': '缺少行程ID'}), 400
 
     try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-
-        itinerary = next(it for it in user['itineraries'] if it['itinerary_id'] == itinerary_id)
-        if itinerary['days'] <= 1:
-            return jsonify({'status': 'error', 'message': '行程天數不能少於1天'}), 400
-
-        users.update_one(
-            {"itineraries.itinerary_id": itinerary_id},
-            {"$inc": {"itineraries.$.days": -1}, "$pop": {"itineraries.$.places": 1}}
+        version, error = update_itinerary(
+            itinerary_id,
+            remove_last_day_pipeline(),
+            conditions={"days": {"$gt": 1}},
+            version=data.get('version'),
+            invalid_message='行程天數不能少於1天'
         )
-        return jsonify({'status': 'success'}), 200
+        if error:
+            return error
+        refresh_itinerary_locations(itinerary_id)
+        return jsonify({'status': 'success', 'version': version}), 200
     except Exception as e:
         print(f'刪除天數時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': f'刪除天數時發生錯誤: {str(e)}'}), 500
@@ -362,15 +1006,14 @@ def add_day():
         return jsonify({'status': 'error', 'message': '缺少行程ID'}), 400
 
     try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-
-        users.update_one(
-            {"itineraries.itinerary_id": itinerary_id},
-            {"$inc": {"itineraries.$.days": 1}, "$push": {"itineraries.$.places": []}}
+        version, error = update_itinerary(
+            itinerary_id,
+            {"$inc": {"days": 1}, "$push": {"places": []}},
+            version=data.get('version')
         )
-        return jsonify({'status': 'success'}), 200
+        if error:
+            return error
+        return jsonify({'status': 'success', 'version': version}), 200
     except Exception as e:
         print(f'添加天數時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': f'添加天數時發生錯誤: {str(e)}'}), 500
@@ -386,26 +1029,27 @@ def move_place():
     if not all([itinerary_id, day_index is not None, place_index is not None, direction]):
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
-    try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-
-        itinerary = next(it for it in user['itineraries'] if it['itinerary_id'] == itinerary_id)
-        places = itinerary['places'][day_index]
-
-        if direction == 'up' and place_index > 0:
-            places.insert(place_index - 1, places.pop(place_index))
-        elif direction == 'down' and place_index < len(places) - 1:
-            places.insert(place_index + 1, places.pop(place_index))
-        else:
-            return jsonify({'status': 'error', 'message': '移動方向無效或位置錯誤'}), 400
+    # 上移或下移都是交換相鄰兩個景點，換算成較前面的那個索引
+    if direction == 'up' and place_index > 0:
+        swap_index = place_index - 1
+    elif direction == 'down' and place_index >= 0:
+        swap_index = place_index
+    else:
+        return jsonify({'status': 'error', 'message': '移動方向無效或位置錯誤'}), 400
+    if day_index < 0:
+        return jsonify({'status': 'error', 'message': '移動方向無效或位置錯誤'}), 400
 
-        users.update_one(
-            {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-            {"$set": {"itineraries.$.places": itinerary['places']}}
+    try:
+        version, error = update_itinerary(
+            itinerary_id,
+            swap_adjacent_places_pipeline(day_index, swap_index),
+            conditions={f"places.{day_index}.{swap_index + 1}": {"$exists": True}},
+            version=data.get('version'),
+            invalid_message='移動方向無效或位置錯誤'
         )
-        return jsonify({'status': 'success'}), 200
+        if error:
+            return error
+        return jsonify({'status': 'success', 'version': version}), 200
 
     except Exception as e:
         print(f'移動地點時發生錯誤: {e}')
@@ -421,30 +1065,73 @@ def delete_place():
     if not all([itinerary_id, day_index is not None, place_index is not None]):
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
-    try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
-            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-
-        itinerary = next(it for it in user['itineraries'] if it['itinerary_id'] == itinerary_id)
-        places = itinerary['places'][day_index]
-
-        if place_index < 0 or place_index >= len(places):
-            return jsonify({'status': 'error', 'message': '地點索引無效'}), 400
-
-        places.pop(place_index)
+    if day_index < 0 or place_index < 0:
+        return jsonify({'status': 'error', 'message': '地點索引無效'}), 400
 
-        users.update_one(
-            {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-            {"$set": {"itineraries.$.places": itinerary['places']}}
+    try:
+        version, error = update_itinerary(
+            itinerary_id,
+            remove_place_pipeline(day_index, place_index),
+            conditions={f"places.{day_index}.{place_index}": {"$exists": True}},
+            version=data.get('version'),
+            invalid_message='地點索引無效'
         )
-        return jsonify({'status': 'success'}), 200
+        if error:
+            return error
+        refresh_itinerary_locations(itinerary_id)
+        return jsonify({'status': 'success', 'version': version}), 200
 
     except Exception as e:
         print(f'刪除地點時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': f'刪除地點時發生錯誤: {str(e)}'}), 500
     
  
+@app.route('/api/itinerary/batch', methods=['POST'])  # --------------------一次套用多個行程編輯操作
+def batch_itinerary_operations():
+    data = request.json
+    itinerary_id = data.get('itinerary_id')
+    operations = data.get('operations')
+    version = data.get('version')
+
+    if not itinerary_id or not isinstance(operations, list) or not operations:
+        return jsonify({'status': 'error', 'message': '缺少行程ID或操作列表'}), 400
+    if len(operations) > ITINERARY_BATCH_MAX_OPERATIONS:
+        return jsonify({'status': 'error', 'message': f'一次最多 {ITINERARY_BATCH_MAX_OPERATIONS} 個操作'}), 400
+
+    try:
+        itinerary = find_itinerary(itinerary_id)
+        if not itinerary:
+            return jsonify({'status': 'error', 'message': '找不到行程'}), 404
+
+        base_version = itinerary.get('version', 0)
+        if version is not None and version != base_version:
+            return jsonify({'status': 'error', 'message': '行程已在其他地方被修改，請重新整理', 'version': base_version}), 409
+
+        try:
+            places, days = apply_itinerary_operations(itinerary, operations)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+
+        # 整批結果以一次條件式更新寫回，單一文件的更新在 MongoDB 中是原子的：
+        # 要嘛全部套用，要嘛因為版本不符而完全不寫入
+        result = itineraries.find_one_and_update(
+            {"itinerary_id": itinerary_id, "version": version_condition(base_version)},
+            with_version_bump({"$set": {"places": places, "days": days, "place_ids": itinerary_place_ids({"places": places})}}),
+            projection={"_id": 0, "version": 1},
+            return_document=ReturnDocument.AFTER
+        )
+        if not result:
+            current = itineraries.find_one({"itinerary_id": itinerary_id}, {"_id": 0, "version": 1}) or {}
+            return jsonify({'status': 'error', 'message': '行程已在其他地方被修改，請重新整理', 'version': current.get('version')}), 409
+
+        if any(operation.get('op') != 'move_place' for operation in operations):
+            refresh_itinerary_locations(itinerary_id)
+        return jsonify({'status': 'success', 'version': result['version'], 'applied': len(operations)}), 200
+
+    except Exception as e:
+        print(f'批次更新行程時發生錯誤: {e}')
+        return jsonify({'status': 'error', 'message': f'批次更新行程時發生錯誤: {str(e)}'}), 500
+
 @app.route('/api/optimize_route', methods=['POST']) # ------------------------------------------實現最短路徑按鈕
 def optimize_route():
     data = request.json
@@ -454,30 +1141,27 @@ def optimize_route():
     if not all([itinerary_id, day_index is not None]):
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
-    user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-    if not user:
+    itinerary = find_itinerary(itinerary_id)
+    if not itinerary:
         return jsonify({'status': 'error', 'message': '找不到行程'}), 404
 
-    itinerary = next(it for it in user['itineraries'] if it['itinerary_id'] == itinerary_id)
     places = itinerary['places'][day_index]
 
     if len(places) < 2:
         return jsonify({'status': 'error', 'message': '地點數量不足'}), 400
 
-    origins = '|'.join([f"{place['latitude']},{place['longitude']}" for place in places])
-
     try:
-        response_data = calculate_distance_matrix(origins, GOOGLE_MAPS_API_KEY)
-        if response_data['status'] != 'OK':
+        distances = build_distance_matrix(places, GOOGLE_MAPS_API_KEY, distance_cache)
+        if distances is None:
             return jsonify({'status': 'error', 'message': 'Google API錯誤'}), 500
 
-        distances = extract_distances(response_data)
-        sorted_places = find_best_route(distances, places)
+        sorted_places, total_distance = find_best_route(distances, places)
+        print(f"最佳路線總距離: {total_distance} 公尺")
 
         # 更新 MongoDB 中的行程順序
-        users.update_one(
-            {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-            {"$set": {f"itineraries.$.places.{day_index}": sorted_places}}
+        itineraries.update_one(
+            {"itinerary_id": itinerary_id},
+            with_version_bump(set_day_pipeline(day_index, sorted_places))
         )
         return jsonify({'status': 'success', 'route': sorted_places}), 200
 
@@ -497,110 +1181,162 @@ def update_place_order():
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
     try:
-        user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-        if not user:
+        itinerary = find_itinerary(itinerary_id)
+        if not itinerary:
             return jsonify({'status': 'error', 'message': '找不到行程'}), 404
 
-        itinerary = next(it for it in user['itineraries'] if it['itinerary_id'] == itinerary_id)
         itinerary['places'][day_index] = places
 
-        users.update_one(
-            {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-            {"$set": {f"itineraries.$.places.{day_index}": places}}
+        itineraries.update_one(
+            {"itinerary_id": itinerary_id},
+            with_version_bump(set_day_pipeline(day_index, places))
         )
+        refresh_itinerary_locations(itinerary_id)
         return jsonify({'status': 'success'}), 200
 
     except Exception as e:
         print(f'更新地點順序時發生錯誤: {e}')
         return jsonify({'status': 'error', 'message': f'更新地點順序時發生錯誤: {str(e)}'}), 500
     
-@app.route('/api/process_city_selection', methods=['POST'])# ------------------------------------------智能推薦景點
-def process_city_selection():
-    data = request.json
+# 智能推薦流程的整體時限與各階段預算（秒），可在 env.json 的 CITY_SELECTION_TIMEOUTS 覆寫
+CITY_SELECTION_TIMEOUTS = {
+    "total": 30,
+    "places": 6,
+    "itinerary": 3,
+    "gemini": 15,
+    "distance": 8,
+    "route": 3,
+    "save": 3,
+    **env.get('CITY_SELECTION_TIMEOUTS', {})
+}
+city_selection_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='city-selection')
+
+def recommend_places(city_name, places_list):
+    # 先查推薦快取，池子未滿時才調用 Gemini API
+    cache_key = recommendation_cache.key(city_name, places_list)
+    selected = recommendation_cache.get(cache_key)
+    if selected is not None:
+        print("使用快取的推薦結果")
+        return selected
+    print("調用 Gemini API")
+    selected, error = select_places_with_gemini(places_list)
+    if error:
+        raise PipelineError(500, error)
+    recommendation_cache.add(cache_key, selected)
+    return selected
+
+def save_city_selection(itinerary_id, day_index, sorted_places):
+    itineraries.update_one(
+        {"itinerary_id": itinerary_id},
+        with_version_bump(set_day_pipeline(day_index, sorted_places))
+    )
+    refresh_itinerary_locations(itinerary_id)
+
+def city_selection_stages(city_name, itinerary_id, day_index):
+    # 依序產生 (事件名稱, 資料)；失敗時拋出 PipelineError
+    timeouts = CITY_SELECTION_TIMEOUTS
+    runner = StageRunner(city_selection_executor, timeouts['total'])
+    # 行程查詢與景點目錄查詢同時進行
+    itinerary_future = runner.submit(find_itinerary, itinerary_id, {"_id": 1})
+
+    print("查詢指定縣市的景點")
+    high_rated_places = runner.run('查詢景點', timeouts['places'], place_catalog.high_rated_places, city_name)
+    print(f"查詢結果: {len(high_rated_places)} 個高評價景點")
+    if not high_rated_places:
+        raise PipelineError(404, '找不到該縣市的景點')
+
+    # 準備景點信息列表
+    places_list = [
+        {
+            "place_id": place['place_id'],
+            "name": place['name'],
+            "latitude": place['geometry']['location']['lat'],
+            "longitude": place['geometry']['location']['lng'],
+            "address": place.get('formatted_address', place.get('vicinity', '')),
+            "visited": False
+        }
+        for place in high_rated_places
+    ]
+
+    # 行程不存在就不必再呼叫 Gemini
+    if not runner.wait('查詢行程', itinerary_future, timeouts['itinerary']):
+        print("找不到行程")
+        raise PipelineError(404, '找不到行程')
+
+    selected = runner.run('挑選景點', timeouts['gemini'], recommend_places, city_name, places_list)
+    yield 'candidates', {'places': selected}
+
+    # 調用最佳路線計算
+    print("調用最佳路線計算")
+    distances = runner.run('距離矩陣', timeouts['distance'], build_distance_matrix, selected, GOOGLE_MAPS_API_KEY, distance_cache)
+    if distances is None:
+        raise PipelineError(500, 'Google API錯誤')
+    sorted_places, total_distance = runner.run('路線計算', timeouts['route'], find_best_route, distances, selected)
+    print(f"最佳路線計算結果: {sorted_places}，總距離: {total_distance} 公尺")
+    yield 'route', {'places': sorted_places, 'total_distance': total_distance}
+
+    # 更新 MongoDB
+    print("更新 MongoDB")
+    runner.run('儲存行程', timeouts['save'], save_city_selection, itinerary_id, day_index, sorted_places)
+    print("更新 MongoDB 成功")
+    yield 'done', {'status': 'success', 'places': sorted_places}
+
+def parse_city_selection(data):
     city_name = data.get('city_name')
     itinerary_id = data.get('itinerary_id')
     day_index = data.get('day_index')
-
     if not all([city_name, itinerary_id, day_index is not None]):
+        return None
+    return city_name, itinerary_id, day_index
+
+@app.route('/api/process_city_selection', methods=['POST'])# ------------------------------------------智能推薦景點
+def process_city_selection():
+    params = parse_city_selection(request.json or {})
+    if params is None:
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
     try:
-        # 查詢指定縣市的景點
-        print("查詢指定縣市的景點")
-        places = get_places_by_city(gmaps, city_name)
-        high_rated_places = filter_high_rated_places(places)
-        print(f"查詢結果: {len(high_rated_places)} 個高評價景點")
-
-        # 準備景點信息列表
-        places_list = [
-            {
-                "place_id": place['place_id'],
-                "name": place['name'],
-                "latitude": place['geometry']['location']['lat'],
-                "longitude": place['geometry']['location']['lng'],
-                "address": place.get('formatted_address', place.get('vicinity', '')),
-                "visited": False
-            }
-            for place in high_rated_places
-        ]
-
-        # 調用 Gemini API
-        print("調用 Gemini API")
-        prompt = '''
-        請依據我給你JSON景點內容，依照我給你的條件回覆我
-        1. 從JSON裡面挑選出五個你覺得推薦且值得拜訪的景點，不可以從前面開始選，一定要依照我給的資料中隨機選取
-        2. 如果name有顯示單獨縣市名稱、停車場相關，廁所相關都不列入你的選項
-        3. 請勿回復其他訊息
-        4. 以我傳給你的JSON樣式保持原樣，回覆我你排的順序就好，每次都可以不一樣
-        '''
-        prompt += json.dumps(places_list, ensure_ascii=False, indent=4)
-        r = model.generate_content(
-            [prompt],
-            generation_config=generation_config
-        )
+        result = None
+        for event, payload in city_selection_stages(*params):
+            if event == 'done':
+                result = payload
+        return jsonify(result), 200
+
+    except PipelineError as e:
+        print(f'處理縣市選擇時發生錯誤: {e.message}')
+        return jsonify({'status': 'error', 'message': e.message}), e.status
+    except Exception as e:
+        print(f'處理縣市選擇時發生錯誤: {e}')
+        return jsonify({'status': 'error', 'message': f'處理縣市選擇時發生錯誤: {str(e)}'}), 500
 
-        # 確保回應為有效的 JSON
-        print("處理 Gemini 回應")
-        if isinstance(r.text, str):
-            try:
-                gemini_response = json.loads(r.text.strip())
-            except json.JSONDecodeError:
-                return jsonify({'status': 'error', 'message': 'Gemini 回應無效的 JSON'}), 500
-
-            # 調用最佳路線計算
-            print("調用最佳路線計算")
-            origins = '|'.join([f"{place['latitude']},{place['longitude']}" for place in gemini_response])
-            response_data = calculate_distance_matrix(origins, GOOGLE_MAPS_API_KEY)
-            if response_data['status'] != 'OK':
-                print(f"Google API 錯誤: {response_data['status']}")
-                return jsonify({'status': 'error', 'message': 'Google API錯誤'}), 500
-
-            distances = extract_distances(response_data)
-            sorted_places = find_best_route(distances, gemini_response)
-            print(f"最佳路線計算結果: {sorted_places}")
-
-            # 更新 MongoDB
-            print("更新 MongoDB")
-            user = users.find_one({"itineraries.itinerary_id": itinerary_id})
-            if not user:
-                print("找不到行程")
-                return jsonify({'status': 'error', 'message': '找不到行程'}), 404
-
-            users.update_one(
-                {"_id": user['_id'], "itineraries.itinerary_id": itinerary_id},
-                {"$set": {f"itineraries.$.places.{day_index}": sorted_places}}
-            )
-            print("更新 MongoDB 成功")
+@app.route('/api/process_city_selection/stream', methods=['POST'])
+def process_city_selection_stream():
+    # Server-Sent Events 版本：每個階段完成就推送給 LIFF，先看到推薦景點再等最佳路線
+    params = parse_city_selection(request.json or {})
+    if params is None:
+        return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
-            return jsonify({'status': 'success', 'places': sorted_places}), 200
+    def generate():
+        try:
+            for event, payload in city_selection_stages(*params):
+                yield sse_event(event, payload)
+        except PipelineError as e:
+            print(f'處理縣市選擇時發生錯誤: {e.message}')
+            yield sse_event('error', {'status': e.status, 'message': e.message})
+        except Exception as e:
+            print(f'處理縣市選擇時發生錯誤: {e}')
+            yield sse_event('error', {'status': 500, 'message': f'處理縣市選擇時發生錯誤: {str(e)}'})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
-        else:
-            return jsonify({'status': 'error', 'message': 'Gemini API 回應格式錯誤'}), 500
+@app.route('/api/recommendation_cache/stats', methods=['GET'])
+def recommendation_cache_stats():
+    return jsonify(recommendation_cache.stats()), 200
 
-    except Exception as e:
-        print(f'處理縣市選擇時發生錯誤: {e}')
-        return jsonify({'status': 'error', 'message': f'處理縣市選擇時發生錯誤: {str(e)}'}), 500
-    
 # ------------------------------------------------------------------------------ raman part
 # 添加在 checkin 函數之前，定義一個函數，用於檢查用戶是否已經在某個地點打卡
 @app.route('/api/check_nearby_places', methods=['POST'])
@@ -614,18 +1350,31 @@ def check_nearby_places():
         return jsonify({"error": "Missing data"}), 400
 
     try:
-        user = users.find_one({"_id": user_profile["userId"]})
-        if not user or 'itineraries' not in user:
-            return jsonify([]), 200
-
-        nearby_places = []
-        for itinerary in user['itineraries']:
-            for day in itinerary.get('places', []):
-                for place in day:
-                    distance = geodesic((place['latitude'], place['longitude']), (latitude, longitude)).km
-                    if distance <= 1:
-                        nearby_places.append(place)
+        radius_km = min(float(data.get('radiusKm', NEARBY_DEFAULT_RADIUS_KM)), NEARBY_MAX_RADIUS_KM)
+        limit = min(int(data.get('limit', NEARBY_DEFAULT_LIMIT)), NEARBY_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid radiusKm or limit"}), 400
+    if radius_km <= 0 or limit <= 0:
+        return jsonify({"error": "Invalid radiusKm or limit"}), 400
 
+    try:
+        user_id = user_profile["userId"]
+        # 剛搬移的行程鏡像還在背景建立，這次先用記憶體計算
+        migrated = migrate_user_itineraries(user_id)
+        if use_place_geo_index and not migrated:
+            try:
+                nearby_places = find_nearby_places_indexed(place_locations, user_id, latitude, longitude, radius_km, limit)
+                return jsonify(nearby_places), 200
+            except OperationFailure as e:
+                app.logger.warning("Geo query failed, falling back to in-memory search: %s", e)
+
+        places = [
+            place
+            for itinerary in itineraries.find({"user_id": user_id}, {"_id": 0, "places": 1})
+            for day in itinerary.get('places', [])
+            for place in day
+        ]
+        nearby_places = find_nearby_places_in_memory(places, latitude, longitude, radius_km, limit)
         return jsonify(nearby_places), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -662,32 +1411,28 @@ def checkin():
     }
 
     try:
-        # 先保存打卡紀錄
-        users.update_one(
-            {"_id": user_profile["userId"]},
-            {"$push": {"checkins": checkin_record}},
-            upsert=True
-        )
+        # 有指定景點時，以 place_ids 索引找出含該景點的行程，再用一次 arrayFilters 更新標記為 visited
+        # 打卡記錄 linkedPlace，刪除打卡時不必再比對座標
+        if selected_place_id:
+            migrate_user_itineraries(user_profile["userId"])
+            backfill_user_place_ids(user_profile["userId"])
+            linked_ids = [
+                itinerary['itinerary_id']
+                for itinerary in itineraries.find({"user_id": user_profile["userId"], "place_ids": selected_place_id}, {"_id": 0, "itinerary_id": 1})
+            ]
+            if linked_ids:
+                result = itineraries.update_many(
+                    {"itinerary_id": {"$in": linked_ids}, "place_ids": selected_place_id},
+                    with_version_bump({"$set": {"places.$[].$[place].visited": True}}),
+                    array_filters=[{"place.place_id": selected_place_id}]
+                )
+                checkin_record['linkedPlace'] = {"place_id": selected_place_id, "itinerary_ids": linked_ids}
+                if result.modified_count > 0:
+                    checkin_record['palseCheckin'] = True
+                    refresh_place_id_locations(user_profile["userId"], selected_place_id)
 
-        
-        # 檢查並更新最近的在1公里以內的地點的 `visited` 屬性
-        user = users.find_one({"_id": user_profile["userId"]})
-        if user and 'itineraries' in user:
-            if selected_place_id:
-                for itinerary in user['itineraries']:
-                    for day in itinerary.get('places', []):
-                        for place in day:
-                            if place['place_id'] == selected_place_id:
-                                place['visited'] = True
-                                users.update_one(
-                                    {"_id": user_profile["userId"], "itineraries.itinerary_id": itinerary["itinerary_id"]},
-                                    {"$set": {f"itineraries.$.places": itinerary['places']}}
-                                )
-                                checkin_record['palseCheckin'] = True
-                                users.update_one(
-                                    {"_id": user_profile["userId"], "checkins.checkinId": checkin_id},
-                                    {"$set": {"checkins.$.palseCheckin": True}}
-                                )
+        # 保存打卡紀錄
+        checkins.insert_one(checkin_document(user_profile["userId"], checkin_record))
 
         return jsonify({"checkinId": checkin_id, "palseCheckin": checkin_record['palseCheckin']}), 200
     except Exception as e:
@@ -697,16 +1442,44 @@ def checkin():
 
 @app.route('/api/fetch_checkins', methods=['POST'])  #修改取回打卡數據API，只返回當前用戶的數據
 def fetch_checkins():
-    user_profile = request.get_json().get('userProfile')
+    # 沒帶 limit/cursor 時維持舊行為回傳完整陣列；帶了則回傳 {checkins, nextCursor} 分頁結果
+    # 可選參數：fields 只回傳指定欄位、since/until 時間區間（ISO 8601）、order 為 asc 或 desc
+    data = request.get_json()
+    user_profile = data.get('userProfile')
     if not user_profile:
         return jsonify({"error": "Missing user profile"}), 400
 
+    view_width, preferred_format = parse_photo_view_options(data)
+    paginated = 'limit' in data or 'cursor' in data
+    descending = data.get('order') == 'desc'
     try:
-        user_checkins = users.find_one({"_id": user_profile["userId"]}, {"_id": 0, "checkins": 1})
-        if user_checkins and "checkins" in user_checkins:
-            return jsonify(user_checkins["checkins"]), 200
-        else:
-            return jsonify([]), 200
+        since = parse_time_filter(data['since']) if data.get('since') else None
+        until = parse_time_filter(data['until']) if data.get('until') else None
+        after = decode_checkin_cursor(data['cursor']) if data.get('cursor') else None
+        limit = min(max(int(data.get('limit') or CHECKIN_PAGE_DEFAULT_LIMIT), 1), CHECKIN_PAGE_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({"error": "Invalid pagination parameters"}), 400
+
+    try:
+        user_id = user_profile["userId"]
+        migrate_user_checkins(user_id)
+        direction = -1 if descending else 1
+        cursor = checkins.find(
+            checkin_page_query(user_id, since, until, after, descending),
+            checkin_projection(data.get('fields'))
+        ).sort([("ts", direction), ("_id", direction)])
+        if paginated:
+            cursor = cursor.limit(limit + 1)
+        docs = list(cursor)
+
+        next_cursor = None
+        if paginated and len(docs) > limit:
+            docs = docs[:limit]
+            next_cursor = encode_checkin_cursor(docs[-1])
+        results = [attach_display_photos(public_checkin(doc), view_width, preferred_format) for doc in docs]
+        if paginated:
+            return jsonify({"checkins": results, "nextCursor": next_cursor}), 200
+        return jsonify(results), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -719,39 +1492,38 @@ def delete_checkin():
         return jsonify({"error": "Missing checkinId"}), 400
 
     try:
-        user_checkin = users.find_one({'checkins.checkinId': checkin_id})
-        if not user_checkin:
-            return jsonify({'error': 'Checkin not found'}), 404
-
-        checkin = next((item for item in user_checkin['checkins'] if item['checkinId'] == checkin_id), None)
+        checkin = find_checkin(checkin_id)
         if checkin:
             palseCheckin = checkin.get('palseCheckin', False)
-
-            # 删除 Google Cloud Storage 中的文件
-            if 'photos' in checkin:
-                for photo_url in checkin['photos']:
-                    blob_name = photo_url.split(f"https://storage.googleapis.com/{bucket_name}/")[-1]
-                    blob = bucket.blob(blob_name)
-                    blob.delete()
-            # 從用戶的checkins列表中刪除此打卡記錄
-            users.update_one(
-                {'checkins.checkinId': checkin_id},
-                {'$pull': {'checkins': {'checkinId': checkin_id}}}
-            )
-
-            if palseCheckin:
-                user = users.find_one({"_id": user_checkin["_id"]})
-                if user and 'itineraries' in user:
-                    for itinerary in user['itineraries']:
-                        for day in itinerary.get('places', []):
-                            for place in day:
-                                if place['latitude'] == checkin['latitude'] and place['longitude'] == checkin['longitude']:
-                                    place['visited'] = False
-                                    users.update_one(
-                                        {"_id": user["_id"], "itineraries.itinerary_id": itinerary["itinerary_id"]},
-                                        {"$set": {f"itineraries.$.places": itinerary['places']}}
-                                    )
-                                    break
+            user_id = checkin['user_id']
+
+            # 刪除此打卡記錄；以刪除當下的文件計算物件名稱，才會包含剛寫入的縮圖
+            checkin = checkins.find_one_and_delete({'_id': checkin_id}) or checkin
+            # 照片與縮圖排入刪除佇列，由背景執行緒刪除 Google Cloud Storage 中的文件
+            gcs_delete_outbox.enqueue(checkin_blob_names(bucket_name, checkin))
+
+            linked_place = checkin.get('linkedPlace')
+            if linked_place:
+                itineraries.update_many(
+                    {"itinerary_id": {"$in": linked_place['itinerary_ids']}, "place_ids": linked_place['place_id']},
+                    with_version_bump({"$set": {"places.$[].$[place].visited": False}}),
+                    array_filters=[{"place.place_id": linked_place['place_id']}]
+                )
+                refresh_place_id_locations(user_id, linked_place['place_id'])
+            elif palseCheckin:
+                # 沒有 linkedPlace 的舊打卡只能比對座標
+                migrate_user_itineraries(user_id)
+                for itinerary in itineraries.find({"user_id": user_id}, {"_id": 0}):
+                    for day in itinerary.get('places', []):
+                        for place in day:
+                            if place['latitude'] == checkin['latitude'] and place['longitude'] == checkin['longitude']:
+                                place['visited'] = False
+                                itineraries.update_one(
+                                    {"itinerary_id": itinerary["itinerary_id"]},
+                                    with_version_bump({"$set": {"places": itinerary['places']}})
+                                )
+                                refresh_itinerary_locations(itinerary["itinerary_id"])
+                                break
 
             return jsonify({'status': 'success', 'message': 'Check-in deleted successfully'}), 200
         else:
@@ -762,11 +1534,12 @@ def delete_checkin():
 
 @app.route('/api/checkin/<checkin_id>', methods=['POST'])  # 確保允許 POST 方法#4
 def get_checkin(checkin_id):
+    view_width, preferred_format = parse_photo_view_options(request.get_json(silent=True) or {})
     try:
         # 根據 checkin_id 查找打卡記錄
-        user_checkin = users.find_one({'checkins.checkinId': checkin_id}, {'checkins.$': 1})
-        if user_checkin and 'checkins' in user_checkin and user_checkin['checkins']:
-            checkin = user_checkin['checkins'][0]
+        checkin = find_checkin(checkin_id)
+        if checkin:
+            checkin = attach_display_photos(public_checkin(checkin), view_width, preferred_format)
             return jsonify(checkin), 200
         else:
             return jsonify({'error': 'Checkin not found'}), 404
@@ -788,47 +1561,131 @@ def update_checkin():
 
     update_data = {}
     if checkin_name:
-        update_data["checkins.$.checkinName"] = checkin_name
+        update_data["checkinName"] = checkin_name
     if description:
-        update_data["checkins.$.description"] = description
+        update_data["description"] = description
 
     # 檢查現有照片數量
-    user_checkin = users.find_one({"checkins.checkinId": checkin_id}, {"checkins.$": 1})
-    if user_checkin and 'checkins' in user_checkin and user_checkin['checkins']:
-        existing_photos = user_checkin['checkins'][0].get('photos', [])
-        if len(existing_photos) + len(photos) > 9:
+    checkin = find_checkin(checkin_id, {"photos": 1})
+    if not checkin:
+        return jsonify({"error": "Checkin not found"}), 404
+    if len(checkin.get('photos', [])) + len(photos) > MAX_CHECKIN_PHOTOS:
+        return jsonify({"error": "最多只能上傳9張照片"}), 400
+
+    # 同時上傳所有照片，只有確定上傳成功的照片網址才會寫進 MongoDB
+    photo_urls, failed_photos = upload_photos(
+        bucket, f"{user_id}/{checkin_id}/", f"{checkin_id}_", photos, on_late_upload=gcs_delete_outbox.enqueue
+    )
+
+    try:
+        update = {}
+        if update_data:
+            update["$set"] = update_data
+        if photo_urls:
+            update["$push"] = {"photos": {"$each": photo_urls}}  # 使用 $push 和 $each 追加多張照片
+        query = {"_id": checkin_id}
+        if photo_urls:
+            query.update(photo_limit_condition(len(photo_urls)))  # 上傳期間其他請求已加入照片時不會超過上限
+        if update and checkins.update_one(query, update).matched_count == 0:
+            if photo_urls:
+                gcs_delete_outbox.enqueue([blob_name_from_url(bucket_name, url) for url in photo_urls])
+                if find_checkin(checkin_id, {"_id": 1}):
+                    return jsonify({"error": "最多只能上傳9張照片"}), 400
+            return jsonify({"error": "Checkin not found"}), 404
+        # 照片確定寫入後才產生縮圖，縮圖寫回時原圖一定已在 photos 中
+        schedule_photo_variants(bucket, photo_urls, record_photo_variants(checkin_id))
+        if failed_photos:
+            # 部分成功：回傳已加入的照片與失敗的照片，讓前端只重傳失敗的部分
+            return jsonify({
+                "message": "部分照片上傳失敗",
+                "uploaded": photo_urls,
+                "failed": failed_photos
+            }), 207
+        return jsonify({"message": "Checkin updated successfully", "uploaded": photo_urls}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+@app.route('/api/checkin/<checkin_id>/upload_urls', methods=['POST'])
+def create_photo_upload_urls(checkin_id):
+    # 第一階段：檢查張數上限後發出限定在 {user_id}/{checkin_id}/ 底下的簽署上傳網址
+    data = request.json
+    user_id = data.get('userId')
+    files = data.get('files')
+
+    if not user_id or not isinstance(files, list) or not files:
+        return jsonify({"error": "Missing data"}), 400
+    if any(not str(f.get('contentType', '')).startswith('image/') for f in files):
+        return jsonify({"error": "只能上傳圖片"}), 400
+
+    try:
+        checkin = find_checkin(checkin_id, {"user_id": 1, "photos": 1})
+        if not checkin or checkin['user_id'] != user_id:
+            return jsonify({"error": "Checkin not found"}), 404
+
+        existing_photos = checkin.get('photos', [])
+        if len(existing_photos) + len(files) > MAX_CHECKIN_PHOTOS:
             return jsonify({"error": "最多只能上傳9張照片"}), 400
 
-    photo_urls = []
-    for photo in photos:
-        photo_filename = f"{checkin_id}_{photo.filename}"
-        folder_path = f"{user_id}/{checkin_id}/"
-        blob = bucket.blob(f"{folder_path}{photo_filename}")
-        blob.upload_from_file(photo, content_type=photo.content_type)
-        photo_url = f"https://storage.googleapis.com/{bucket_name}/{folder_path}{photo_filename}"
-        photo_urls.append(photo_url)
+        uploads = []
+        for f in files:
+            object_name = f"{user_id}/{checkin_id}/{checkin_id}_{uuid.uuid4().hex[:8]}_{safe_photo_filename(f.get('filename'))}"
+            uploads.append({
+                "filename": f.get('filename'),
+                "objectName": object_name,
+                "contentType": f['contentType'],
+                "uploadUrl": generate_upload_url(bucket, object_name, f['contentType']),
+                "photoUrl": gcs_public_url(bucket_name, object_name)
+            })
+        return jsonify({"uploads": uploads, "expiresIn": SIGNED_UPLOAD_EXPIRES_SECONDS}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/checkin/<checkin_id>/confirm_uploads', methods=['POST'])
+def confirm_photo_uploads(checkin_id):
+    # 第二階段：前端上傳完成後回報，確認物件確實存在於 GCS 才把網址加進打卡紀錄
+    data = request.json
+    user_id = data.get('userId')
+    object_names = data.get('objectNames')
+
+    if not user_id or not isinstance(object_names, list) or not object_names:
+        return jsonify({"error": "Missing data"}), 400
+
+    prefix = f"{user_id}/{checkin_id}/"
+    if any(not isinstance(name, str) or not name.startswith(prefix) or '..' in name for name in object_names):
+        return jsonify({"error": "Invalid object name"}), 400
 
     try:
+        checkin = find_checkin(checkin_id, {"user_id": 1, "photos": 1})
+        if not checkin or checkin['user_id'] != user_id:
+            return jsonify({"error": "Checkin not found"}), 404
+
+        existing_photos = checkin.get('photos', [])
+        stored = existing_blob_names(bucket, prefix)
+        missing = [name for name in object_names if name not in stored]
+        photo_urls = []
+        for name in object_names:
+            url = gcs_public_url(bucket_name, name)
+            if name in stored and url not in existing_photos and url not in photo_urls:
+                photo_urls.append(url)
+
+        if len(existing_photos) + len(photo_urls) > MAX_CHECKIN_PHOTOS:
+            return jsonify({"error": "最多只能上傳9張照片"}), 400
+
         if photo_urls:
-            result = users.update_one(
-                {"checkins.checkinId": checkin_id},
-                {
-                    "$set": update_data,
-                    "$push": {"checkins.$.photos": {"$each": photo_urls}}  # 使用 $push 和 $each 追加多張照片
-                }
+            # 上限條件放進更新的篩選條件，同時確認的請求不會一起超過 9 張
+            result = checkins.update_one(
+                {"_id": checkin_id, "user_id": user_id, **photo_limit_condition(len(photo_urls))},
+                {"$push": {"photos": {"$each": photo_urls}}}
             )
-        else:
-            result = users.update_one(
-                {"checkins.checkinId": checkin_id},
-                {"$set": update_data}
-            )
-        if result.matched_count > 0:
-            return jsonify({"message": "Checkin updated successfully"}), 200
-        else:
-            return jsonify({"error": "Checkin not found"}), 404
+            if result.matched_count == 0:
+                return jsonify({"error": "最多只能上傳9張照片"}), 400
+            schedule_photo_variants(bucket, photo_urls, record_photo_variants(checkin_id))
+        if missing:
+            return jsonify({"message": "部分照片尚未上傳完成", "uploaded": photo_urls, "missing": missing}), 207
+        return jsonify({"message": "Checkin updated successfully", "uploaded": photo_urls}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    
+
 @app.route('/api/update_photo_order', methods=['POST'])
 def update_photo_order():
     data = request.json
@@ -839,9 +1696,11 @@ def update_photo_order():
         return jsonify({'status': 'error', 'message': '缺少必要的字段'}), 400
 
     try:
-        result = users.update_one(
-            {"checkins.checkinId": checkin_id},
-            {"$set": {"checkins.$.photos": [photo['url'] for photo in photo_order]}}
+        if not find_checkin(checkin_id, {"_id": 1}):
+            return jsonify({'status': 'error', 'message': '打卡記錄未找到'}), 404
+        result = checkins.update_one(
+            {"_id": checkin_id},
+            {"$set": {"photos": [photo['url'] for photo in photo_order]}}
         )
         if result.matched_count > 0:
             return jsonify({'status': 'success'}), 200
@@ -860,11 +1719,7 @@ def set_homepage_photo():
         return jsonify({"error": "Missing data"}), 400
 
     try:
-        user_checkin = users.find_one({'checkins.checkinId': checkin_id})
-        if not user_checkin:
-            return jsonify({'error': 'Checkin not found'}), 404
-
-        checkin = next((item for item in user_checkin['checkins'] if item['checkinId'] == checkin_id), None)
+        checkin = find_checkin(checkin_id, {"photos": 1})
         if checkin:
             photos = checkin.get('photos', [])
             if not photos:
@@ -877,9 +1732,9 @@ def set_homepage_photo():
             index = photos.index(photo_url)
             photos[0], photos[index] = photos[index], photos[0]
 
-            users.update_one(
-                {'checkins.checkinId': checkin_id},
-                {'$set': {'checkins.$.photos': photos}}
+            checkins.update_one(
+                {'_id': checkin_id},
+                {'$set': {'photos': photos}}
             )
 
             return jsonify({'message': 'Homepage photo set successfully'}), 200
@@ -899,23 +1754,17 @@ def delete_photo():
         return jsonify({"error": "Missing data"}), 400
 
     try:
-        user_checkin = users.find_one({'checkins.checkinId': checkin_id})
-        if not user_checkin:
-            return jsonify({'error': 'Checkin not found'}), 404
-
-        checkin = next((item for item in user_checkin['checkins'] if item['checkinId'] == checkin_id), None)
+        checkin = find_checkin(checkin_id)
         if checkin:
             if 'photos' in checkin and photo_url in checkin['photos']:
-                checkin['photos'].remove(photo_url)
-                users.update_one(
-                    {'checkins.checkinId': checkin_id},
-                    {'$set': {'checkins.$.photos': checkin['photos']}}
-                )
+                # 回傳更新前的文件，縮圖剛好在讀取後才寫入時也能一併刪除
+                checkin = checkins.find_one_and_update(
+                    {'_id': checkin_id},
+                    {'$pull': {'photos': photo_url, 'photo_variants': {'url': photo_url}}}
+                ) or checkin
 
-                # 删除 Google Cloud Storage 中的文件
-                blob_name = photo_url.split(f"https://storage.googleapis.com/{bucket_name}/")[-1]
-                blob = bucket.blob(blob_name)
-                blob.delete()
+                # 照片與縮圖排入刪除佇列，由背景執行緒刪除 Google Cloud Storage 中的文件
+                gcs_delete_outbox.enqueue(checkin_blob_names(bucket_name, checkin, [photo_url]))
 
                 return jsonify({'message': 'Photo deleted successfully'}), 200
             else:
@@ -925,20 +1774,46 @@ def delete_photo():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+# 景點詳細資料快取，熱門景點不必每個使用者都向 Google 查一次
+place_details_cache = PlaceDetailsCache(
+    http_session,
+    ttl_seconds=env.get('PLACE_DETAILS_CACHE_TTL_SECONDS', PLACE_DETAILS_CACHE_TTL_SECONDS),
+    max_entries=env.get('PLACE_DETAILS_CACHE_MAX_ENTRIES', PLACE_DETAILS_CACHE_MAX_ENTRIES)
+)
+place_details_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='place-details')
+
 @app.route('/api/proxy_google_places', methods=['POST'])
 def proxy_google_places():
     data = request.json
     place_id = data.get('place_id')
+    place_ids = data.get('place_ids')
     api_key = data.get('key')
+    language = data.get('language', 'zh-TW')
+    fields = data.get('fields')
 
-    if not place_id or not api_key:
+    if not (place_id or place_ids) or not api_key:
         return jsonify({'status': 'error', 'message': 'Missing required parameters'}), 400
 
-    google_places_url = f"https://maps.googleapis.com/maps/api/place/details/json?place_id={place_id}&key={api_key}&language=zh-TW"
-
     try:
-        response = requests.get(google_places_url)
-        return jsonify(response.json()), response.status_code
+        if place_id:
+            status_code, body = place_details_cache.get(place_id, api_key, language, fields)
+            return jsonify(body), status_code
+
+        # 一次查詢多個景點，各自查快取，未命中的並行向 Google 查詢
+        if not isinstance(place_ids, list) or len(place_ids) > PLACE_DETAILS_MAX_BATCH:
+            return jsonify({'status': 'error', 'message': f'place_ids must be a list of at most {PLACE_DETAILS_MAX_BATCH} ids'}), 400
+        place_ids = list(dict.fromkeys(place_ids))
+        futures = {
+            pid: place_details_executor.submit(place_details_cache.get, pid, api_key, language, fields)
+            for pid in place_ids
+        }
+        results = {}
+        for pid, future in futures.items():
+            try:
+                results[pid] = future.result()[1]
+            except Exception as e:
+                results[pid] = {'status': 'error', 'message': str(e)}
+        return jsonify({'status': 'success', 'results': results}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 # ------------------------------------------------------------------------------ raman part
@@ -1,8 +1,28 @@
-import itertools
+import base64
+import hashlib
+import heapq
+import json
 import math
+import os
+import random
+import re
+import threading
 import time
+import uuid
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+from pymongo.monitoring import CommandListener
 from geopy.distance import geodesic
+from PIL import Image, ImageOps
 
 def haversine(lon1, lat1, lon2, lat2):
     R = 6371.0  # 地球半徑（公里）
@@ -13,41 +33,557 @@ def haversine(lon1, lat1, lon2, lat2):
     distance = R * c
     return distance
 
-def get_nearest_station(lat, lon, weather_url):
-    response = requests.get(weather_url)
-    data = response.json()
+#-----------------------------------Prometheus 指標
+# 程序內的輕量指標：延遲直方圖、錯誤計數與進行中數量，由 /metrics 以 Prometheus 文字格式輸出
+# 每個指標的標籤組合有上限，超過後新的組合併入 "other"，避免標籤基數無限成長
+METRICS_PREFIX = 'funtravelmap_'
+METRICS_MAX_SERIES = 200
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+def _format_labels(label_names, label_values, le=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(label_names, label_values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, help_text, label_names=(), max_series=METRICS_MAX_SERIES):
+        self.name = METRICS_PREFIX + name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.max_series = max_series
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        # 呼叫端需持有 self._lock
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        if key not in self._series and len(self._series) >= self.max_series:
+            key = tuple('other' for _ in self.label_names)
+        return key
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = list(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}"]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS, max_series=METRICS_MAX_SERIES):
+        super().__init__(name, help_text, label_names, max_series)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def _render_series(self, key, value):
+        counts, total, count = value
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, bound)} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, '+Inf')} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+        lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self.request_duration = self.register(Histogram(
+            'http_request_duration_seconds', 'Flask 請求處理時間', ('method', 'route', 'status')))
+        self.request_errors = self.register(Counter(
+            'http_request_errors_total', '回應 5xx 或拋出例外的請求數', ('method', 'route')))
+        self.requests_in_flight = self.register(Gauge(
+            'http_requests_in_flight', '處理中的請求數', ('route',)))
+        self.dependency_duration = self.register(Histogram(
+            'dependency_duration_seconds', '對外相依服務呼叫時間', ('dependency', 'operation')))
+        self.dependency_errors = self.register(Counter(
+            'dependency_errors_total', '對外相依服務呼叫失敗數', ('dependency', 'operation')))
+        self.dependency_in_flight = self.register(Gauge(
+            'dependency_in_flight', '進行中的對外相依服務呼叫數', ('dependency',)))
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    @contextmanager
+    def track(self, dependency, operation):
+        self.dependency_in_flight.inc(dependency=dependency)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.dependency_errors.inc(dependency=dependency, operation=operation)
+            raise
+        finally:
+            self.dependency_duration.observe(time.perf_counter() - started, dependency=dependency, operation=operation)
+            self.dependency_in_flight.dec(dependency=dependency)
+
+    def instrument(self, fn, dependency, operation):
+        def wrapper(*args, **kwargs):
+            with self.track(dependency, operation):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+class MongoCommandMetrics(CommandListener):
+    # 以 pymongo 指令事件記錄每個 (集合, 指令) 的延遲與錯誤
+    # 完成事件不帶指令內容，集合名稱在 started 時依 request_id 記下
+    def __init__(self, registry):
+        self.registry = registry
+        self._operations = {}
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        operation = f"{target}.{event.command_name}" if isinstance(target, str) else event.command_name
+        self._operations[event.request_id] = operation
+        self.registry.dependency_in_flight.inc(dependency='mongodb')
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed):
+        operation = self._operations.pop(event.request_id, event.command_name)
+        self.registry.dependency_in_flight.dec(dependency='mongodb')
+        self.registry.dependency_duration.observe(event.duration_micros / 1e6, dependency='mongodb', operation=operation)
+        if failed:
+            self.registry.dependency_errors.inc(dependency='mongodb', operation=operation)
+
+#-----------------------------------共用 HTTP 連線池
+# 所有對外的 HTTP 請求共用同一個 Session，每個 host 保留 keep-alive 連線，並套用預設逾時
+# requests 只支援 HTTP/1.1，連線重用已省下大部分 TCP/TLS 交握成本
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+HTTP_POOL_CONNECTIONS = 10  # 保留連線池的 host 數量
+HTTP_POOL_MAXSIZE = 20  # 每個 host 最多保留的連線數
+HTTP_RETRIES = 2
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        host = urlsplit(request.url).hostname or 'unknown'
+        with metrics.track('http', host):
+            response = super().send(request, **kwargs)
+        if response.status_code >= 500:
+            metrics.dependency_errors.inc(dependency='http', operation=host)
+        return response
+
+def configure_http_session(session, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                           pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, retries=HTTP_RETRIES):
+    # 只對 GET 的連線錯誤與 502/503/504 重試，POST 不重送
+    adapter = TimeoutHTTPAdapter(
+        timeout=(connect_timeout, read_timeout),
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = configure_http_session(requests.Session())
+
+#-----------------------------------氣象站空間索引
+# 將測站經緯度轉成單位球上的 3D 向量建立 KD-tree，弦長與球面距離單調對應，
+# 因此最近鄰、k 近鄰與半徑查詢都能在樹上剪枝，平均 O(log n)
+EARTH_RADIUS_KM = 6371.0
+
+def _to_unit_vector(lat, lon):
+    lat_r = math.radians(lat)
+    lon_r = math.radians(lon)
+    return (math.cos(lat_r) * math.cos(lon_r), math.cos(lat_r) * math.sin(lon_r), math.sin(lat_r))
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+def _km_to_chord(km):
+    return 2 * math.sin(min(math.pi, km / EARTH_RADIUS_KM) / 2)
+
+def _station_coordinates(station):
+    coords = station['GeoInfo']['Coordinates'][1]  # 索引 1 為 WGS84 座標
+    return float(coords['StationLatitude']), float(coords['StationLongitude'])
+
+class StationIndex:
+    def __init__(self, stations):
+        self.stations = []
+        points = []
+        for station in stations:
+            try:
+                lat, lon = _station_coordinates(station)
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+            points.append((_to_unit_vector(lat, lon), len(self.stations)))
+            self.stations.append(station)
+        self._root = self._build(points, 0)
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _build(self, points, depth):
+        # 節點格式：(向量, 測站索引, 切分軸, 左子樹, 右子樹)
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda p: p[0][axis])
+        mid = len(points) // 2
+        vector, idx = points[mid]
+        return (vector, idx, axis,
+                self._build(points[:mid], depth + 1),
+                self._build(points[mid + 1:], depth + 1))
+
+    def _search_k(self, target, k):
+        # best 為 (-距離平方, 測站索引) 的最大堆，只保留目前最近的 k 個
+        best = []
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound_sq = stack.pop()
+            if node is None:
+                continue
+            # 子樹與查詢點的距離下界已超過第 k 近的距離，整棵子樹略過
+            if len(best) == k and bound_sq >= -best[0][0]:
+                continue
+            vector, idx, axis, left, right = node
+            dist_sq = sum((a - b) ** 2 for a, b in zip(vector, target))
+            if len(best) < k:
+                heapq.heappush(best, (-dist_sq, idx))
+            elif dist_sq < -best[0][0]:
+                heapq.heapreplace(best, (-dist_sq, idx))
+            diff = target[axis] - vector[axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            # 後進先出：先推遠側，讓近側先展開以盡快縮小搜尋半徑
+            stack.append((far, max(bound_sq, diff * diff)))
+            stack.append((near, bound_sq))
+        return sorted((math.sqrt(-d), idx) for d, idx in best)
+
+    def nearest(self, lat, lon):
+        result = self.k_nearest(lat, lon, 1)
+        return result[0] if result else (None, float('inf'))
+
+    def k_nearest(self, lat, lon, k):
+        if k <= 0 or self._root is None:
+            return []
+        found = self._search_k(_to_unit_vector(lat, lon), k)
+        return [(self.stations[idx], _chord_to_km(chord)) for chord, idx in found]
+
+    def within_radius(self, lat, lon, radius_km):
+        target = _to_unit_vector(lat, lon)
+        max_chord_sq = _km_to_chord(radius_km) ** 2
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            vector, idx, axis, left, right = node
+            dist_sq = sum((a - b) ** 2 for a, b in zip(vector, target))
+            if dist_sq <= max_chord_sq:
+                found.append((math.sqrt(dist_sq), idx))
+            diff = target[axis] - vector[axis]
+            if diff < 0 or diff * diff <= max_chord_sq:
+                stack.append(left)
+            if diff >= 0 or diff * diff <= max_chord_sq:
+                stack.append(right)
+        found.sort()
+        return [(self.stations[idx], _chord_to_km(chord)) for chord, idx in found]
+
+    def nearest_batch(self, coordinates):
+        # 一次解析多組 (lat, lon)，回傳與輸入順序相同的 (測站, 距離公里) 列表
+        return [self.nearest(lat, lon) for lat, lon in coordinates]
+
+def build_station_index(data):
+    return StationIndex(data['records']['Station'])
+
+def station_weather_info(station):
+    return {
+        '縣市': station['GeoInfo']['CountyName'] or "未知",
+        '鄉鎮': station['GeoInfo']['TownName'] or "未知",
+        '天氣': station['WeatherElement']['Weather'] or "未知",
+        '降雨量': station['WeatherElement']['Now'].get('Precipitation', "未知"),
+        '氣溫': station['WeatherElement'].get('AirTemperature', "未知")
+    }
+
+#-----------------------------------天氣快照
+# 中央氣象署 O-A0001-001 每 10 分鐘更新一次，背景執行緒依同樣節奏下載並整份替換快照，
+# 下載失敗時繼續使用舊快照並標記為過期，最後一份成功的資料會寫入磁碟供冷啟動使用
+WEATHER_REFRESH_SECONDS = 600
+WEATHER_REFRESH_OFFSET_SECONDS = 120  # 整點 10 分鐘後再等一下，讓氣象署資料先發布
+WEATHER_RETRY_SECONDS = 60
+WEATHER_MAX_AGE_SECONDS = 1800
+WEATHER_REQUEST_TIMEOUT = 10
+
+class WeatherSnapshot:
+    def __init__(self, data, fetched_at):
+        self.data = data
+        self.fetched_at = fetched_at
+        self.station_index = build_station_index(data)
+
+class WeatherSnapshotStore:
+    def __init__(self, weather_url, cache_path, refresh_seconds=WEATHER_REFRESH_SECONDS,
+                 max_age_seconds=WEATHER_MAX_AGE_SECONDS):
+        self.weather_url = weather_url
+        self.cache_path = cache_path
+        self.refresh_seconds = refresh_seconds
+        self.max_age_seconds = max_age_seconds
+        self._snapshot = None
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+
+    def load_from_disk(self):
+        try:
+            with open(self.cache_path, encoding='utf-8') as f:
+                cached = json.load(f)
+            self._snapshot = WeatherSnapshot(cached['data'], cached['fetched_at'])
+            return True
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print(f"Error in WeatherSnapshotStore.load_from_disk: {e}")
+            return False
+
+    def _save_to_disk(self, snapshot):
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'fetched_at': snapshot.fetched_at, 'data': snapshot.data}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.cache_path)  # 原子替換，避免其他程序讀到寫一半的檔案
+        except Exception as e:
+            print(f"Error in WeatherSnapshotStore._save_to_disk: {e}")
+
+    def refresh(self):
+        with self._refresh_lock:
+            try:
+                response = http_session.get(self.weather_url, timeout=WEATHER_REQUEST_TIMEOUT)
+                response.raise_for_status()
+                snapshot = WeatherSnapshot(response.json(), time.time())
+            except Exception as e:
+                print(f"Error in WeatherSnapshotStore.refresh: {e}")
+                return False
+            self._snapshot = snapshot  # 單一參考賦值，讀取端不會看到半套資料
+            self._save_to_disk(snapshot)
+            return True
+
+    def _seconds_until_next_refresh(self):
+        now = time.time()
+        return self.refresh_seconds - (now % self.refresh_seconds) + WEATHER_REFRESH_OFFSET_SECONDS
+
+    def _run(self):
+        # 只有啟動時檢查磁碟快照的新舊，之後每次排定的喚醒都直接下載
+        snapshot = self._snapshot
+        ok = True
+        if snapshot is None or time.time() - snapshot.fetched_at >= self.refresh_seconds:
+            ok = self.refresh()
+        while True:
+            time.sleep(self._seconds_until_next_refresh() if ok else WEATHER_RETRY_SECONDS)
+            ok = self.refresh()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.load_from_disk()
+        self._thread = threading.Thread(target=self._run, name='weather-refresh', daemon=True)
+        self._thread.start()
+
+    def get(self):
+        # 回傳 (快照, 是否新鮮)；完全沒有資料時才會在請求中同步下載
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.refresh()
+            snapshot = self._snapshot
+            if snapshot is None:
+                return None, False
+        return snapshot, time.time() - snapshot.fetched_at <= self.max_age_seconds
+
+def get_nearest_station(lat, lon, weather_store):
+    snapshot, is_fresh = weather_store.get()
+    if snapshot is None:
+        return "目前無法取得天氣資料"
     
     try:
-        stations = data['records']['Station']
-        nearest_station = None
-        min_distance = float('inf')
-        
-        for station in stations:
-            station_lat = station['GeoInfo']['Coordinates'][1]['StationLatitude']
-            station_lon = station['GeoInfo']['Coordinates'][1]['StationLongitude']
-            distance = haversine(lon, lat, station_lon, station_lat)
-            
-            if distance < min_distance:
-                min_distance = distance
-                nearest_station = station
+        nearest_station, _ = snapshot.station_index.nearest(lat, lon)
         
         if nearest_station:
-            weather_info = {
-                '縣市': nearest_station['GeoInfo']['CountyName'] or "未知",
-                '鄉鎮': nearest_station['GeoInfo']['TownName'] or "未知",
-                '天氣': nearest_station['WeatherElement']['Weather'] or "未知",
-                '降雨量': nearest_station['WeatherElement']['Now'].get('Precipitation', "未知"),
-                '氣溫': nearest_station['WeatherElement'].get('AirTemperature', "未知")
-            }
+            weather_info = station_weather_info(nearest_station)
+            weather_info['資料過期'] = not is_fresh
+            weather_info['更新時間'] = snapshot.fetched_at
             return weather_info
         return "無法找到最近的天氣站"
     except KeyError:
         return "數據結構錯誤，無法提取天氣資訊"
     
+#-----------------------------------通用 LRU 快取（含 TTL）
+class LRUCache:
+    def __init__(self, max_entries, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds=None):
+        ttl_seconds = ttl_seconds if ttl_seconds is not None else self.ttl_seconds
+        expires_at = time.time() + ttl_seconds if ttl_seconds is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[0]
+
+    def __len__(self):
+        return len(self._data)
+
+#-----------------------------------Flex 訊息樣板
+# 樣板只在檔案修改時間變動時重新載入，並預先編譯成只重建含 ${變數} 節點的產生函式，
+# 其他不含變數的子樹在每次渲染間共用；值直接放進 Python 結構，不經過 JSON 字串取代
+TEMPLATE_SLOT_PATTERN = re.compile(r'\$\{(\w+)\}')
+
+def _compile_template_string(text):
+    parts = TEMPLATE_SLOT_PATTERN.split(text)
+    if len(parts) == 1:
+        return None
+    if len(parts) == 3 and parts[0] == '' and parts[2] == '':
+        name = parts[1]
+        return lambda values: values.get(name, '')
+    literals = parts[0::2]
+    names = parts[1::2]
+
+    def render(values):
+        out = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            out.append(values.get(name, ''))
+            out.append(literal)
+        return ''.join(out)
+    return render
+
+def _compile_template_node(node):
+    # 回傳 None 代表整個子樹不含變數，可以直接共用
+    if isinstance(node, str):
+        return _compile_template_string(node)
+    if isinstance(node, dict):
+        compiled = {key: _compile_template_node(value) for key, value in node.items()}
+        if all(fn is None for fn in compiled.values()):
+            return None
+        items = [(key, compiled[key], value) for key, value in node.items()]
+        return lambda values: {key: fn(values) if fn else value for key, fn, value in items}
+    if isinstance(node, list):
+        compiled = [_compile_template_node(item) for item in node]
+        if all(fn is None for fn in compiled):
+            return None
+        items = list(zip(compiled, node))
+        return lambda values: [fn(values) if fn else item for fn, item in items]
+    return None
+
+class FlexTemplate:
+    def __init__(self, path):
+        self.path = path
+        self._compiled = (None, None, None)  # (mtime, 原始樣板, 產生函式)
+        self._lock = threading.Lock()
+
+    def _load(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if self._compiled[0] == mtime:
+            return self._compiled
+        with self._lock:
+            if self._compiled[0] != mtime:
+                with open(self.path, encoding='utf-8') as f:
+                    template = json.load(f)
+                self._compiled = (mtime, template, _compile_template_node(template))
+        return self._compiled
+
+    def render(self, values):
+        _, template, render = self._load()
+        values = {key: str(value) for key, value in values.items()}
+        return render(values) if render else template
+
 #-----------------------------------計算景點之間距離矩陣
-def calculate_distance_matrix(origins, google_maps_api_key):
-    url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={origins}&destinations={origins}&key={google_maps_api_key}"
-    response = requests.get(url)
+# Google Distance Matrix 單次請求最多 25 個起點或終點、100 個元素
+DISTANCE_MATRIX_MAX_DIMENSION = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+DISTANCE_MATRIX_TIMEOUT = 10
+DISTANCE_CACHE_TTL_SECONDS = 30 * 24 * 3600
+DISTANCE_CACHE_MAX_ENTRIES = 20000
+DISTANCE_UNREACHABLE_PENALTY = 10 ** 9  # 無法抵達的組合以極大的有限距離代替，路線計算仍能排出完整順序
+
+_distance_matrix_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='distance-matrix')
+
+def calculate_distance_matrix(origins, google_maps_api_key, destinations=None, mode='driving'):
+    destinations = destinations or origins
+    url = f"https://maps.googleapis.com/maps/api/distancematrix/json?origins={origins}&destinations={destinations}&mode={mode}&key={google_maps_api_key}"
+    response = http_session.get(url, timeout=DISTANCE_MATRIX_TIMEOUT)
     response_data = response.json()
     return response_data
 
@@ -58,48 +594,1116 @@ def extract_distances(response_data):
         distances.append([element['distance']['value'] for element in row['elements']])
     return distances
 
+def place_cache_key(place):
+    # 優先使用 place_id，沒有的話用經緯度（取到小數第 6 位）當作鍵值
+    if place.get('place_id'):
+        return place['place_id']
+    return f"{float(place['latitude']):.6f},{float(place['longitude']):.6f}"
+
+class DistanceMatrixCache:
+    # 以 (起點, 終點, 交通方式) 為鍵，先查行程內記憶體 LRU，再查 MongoDB
+    def __init__(self, collection, ttl_seconds=DISTANCE_CACHE_TTL_SECONDS, max_entries=DISTANCE_CACHE_MAX_ENTRIES):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, ttl_seconds)
+
+    def ensure_indexes(self):
+        # TTL 索引讓 MongoDB 自動清除過期的距離
+        self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    @staticmethod
+    def _key(origin, destination, mode):
+        return f"{origin}|{destination}|{mode}"
+
+    def get_many(self, pairs, mode):
+        found = {}
+        missing_keys = {}
+        for origin, destination in pairs:
+            key = self._key(origin, destination, mode)
+            value = self.memory.get(key)
+            if value is None:
+                missing_keys[key] = (origin, destination)
+            else:
+                found[(origin, destination)] = value
+        if missing_keys:
+            try:
+                docs = self.collection.find(
+                    {"_id": {"$in": list(missing_keys)}, "expires_at": {"$gt": datetime.utcnow()}},
+                    {"distance": 1}
+                )
+                for doc in docs:
+                    self.memory.set(doc['_id'], doc['distance'])
+                    found[missing_keys[doc['_id']]] = doc['distance']
+            except Exception as e:
+                print(f"Error in DistanceMatrixCache.get_many: {e}")
+        return found
+
+    def set_many(self, values, mode):
+        if not values:
+            return
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl_seconds)
+        operations = []
+        for (origin, destination), distance in values.items():
+            key = self._key(origin, destination, mode)
+            self.memory.set(key, distance)
+            operations.append(UpdateOne(
+                {"_id": key},
+                {"$set": {"distance": distance, "expires_at": expires_at}},
+                upsert=True
+            ))
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            print(f"Error in DistanceMatrixCache.set_many: {e}")
+
+def _distance_matrix_tiles(rows, cols):
+    # 把 rows x cols 切成符合 Google 單次請求上限的區塊
+    col_size = min(len(cols), DISTANCE_MATRIX_MAX_DIMENSION)
+    row_size = max(1, min(DISTANCE_MATRIX_MAX_DIMENSION, DISTANCE_MATRIX_MAX_ELEMENTS // col_size))
+    for r in range(0, len(rows), row_size):
+        for c in range(0, len(cols), col_size):
+            yield rows[r:r + row_size], cols[c:c + col_size]
+
+def build_distance_matrix(places, google_maps_api_key, cache=None, mode='driving'):
+    # 只向 Google 查詢快取中沒有的起終點組合，失敗時回傳 None
+    keys = [place_cache_key(place) for place in places]
+    locations = [f"{place['latitude']},{place['longitude']}" for place in places]
+    pairs = {(keys[i], keys[j]) for i in range(len(places)) for j in range(len(places)) if keys[i] != keys[j]}
+    known = cache.get_many(pairs, mode) if cache else {}
+
+    # 依缺少的終點集合分組，只重新加入一個景點時只會查詢新增的那一行與那一列
+    # 彼此都缺少的一組景點（例如快取全空）才把對角線補進去，合併成單一個 N x N 的請求；對角線的結果寫入時再略過
+    first_index = {}
+    for i, key in enumerate(keys):
+        first_index.setdefault(key, i)
+    unique = list(first_index.values())
+    missing = {}
+    for i in unique:
+        cols = {j for j in unique if keys[i] != keys[j] and (keys[i], keys[j]) not in known}
+        if cols:
+            missing[i] = cols
+    with_diagonal = defaultdict(list)
+    for i, cols in missing.items():
+        with_diagonal[frozenset(cols | {i})].append(i)
+    groups = defaultdict(list)
+    for cols, rows in with_diagonal.items():
+        if set(rows) == cols:
+            groups[tuple(j for j in unique if j in cols)].extend(rows)
+        else:
+            for i in rows:
+                groups[tuple(j for j in unique if j in missing[i])].append(i)
+    tiles = [tile for cols, rows in groups.items() for tile in _distance_matrix_tiles(rows, list(cols))]
+
+    def fetch(tile):
+        rows, cols = tile
+        return tile, calculate_distance_matrix(
+            '|'.join(locations[i] for i in rows),
+            google_maps_api_key,
+            destinations='|'.join(locations[j] for j in cols),
+            mode=mode
+        )
+
+    fetched = {}
+    try:
+        for (rows, cols), response_data in _distance_matrix_executor.map(fetch, tiles):
+            if response_data.get('status') != 'OK':
+                print(f"Google API 錯誤: {response_data.get('status')}")
+                return None
+            for i, row in zip(rows, response_data['rows']):
+                for j, element in zip(cols, row['elements']):
+                    if keys[i] == keys[j]:
+                        continue
+                    if element.get('status') == 'OK':
+                        fetched[(keys[i], keys[j])] = element['distance']['value']
+                    else:
+                        print(f"無法計算距離: {locations[i]} -> {locations[j]} ({element.get('status')})")
+                        known[(keys[i], keys[j])] = DISTANCE_UNREACHABLE_PENALTY  # 無法抵達的組合不寫入快取
+    except Exception as e:
+        print(f"Error in build_distance_matrix: {e}")
+        return None
+
+    if cache:
+        cache.set_many(fetched, mode)
+    known.update(fetched)
+    return [[0 if keys[i] == keys[j] else known[(keys[i], keys[j])] for j in range(len(places))]
+            for i in range(len(places))]
+
+#-----------------------------------打卡照片上傳
+# 多張照片以固定大小的執行緒池同時上傳，設定 chunk_size 讓 GCS 改用可續傳的分段上傳
+PHOTO_UPLOAD_WORKERS = 4
+PHOTO_UPLOAD_TIMEOUT = 30  # 單次 HTTP 請求的逾時秒數
+PHOTO_UPLOAD_RETRIES = 3
+PHOTO_UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024  # 必須是 256 KB 的倍數
+
+_photo_upload_executor = ThreadPoolExecutor(max_workers=PHOTO_UPLOAD_WORKERS, thread_name_prefix='photo-upload')
+
+def gcs_public_url(bucket_name, blob_name):
+    return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
+
+def upload_photo(bucket, blob_name, stream, content_type):
+    blob = bucket.blob(blob_name, chunk_size=PHOTO_UPLOAD_CHUNK_SIZE)
+    for attempt in range(1, PHOTO_UPLOAD_RETRIES + 1):
+        try:
+            stream.seek(0)
+            with metrics.track('gcs', 'upload'):
+                blob.upload_from_file(stream, content_type=content_type, timeout=PHOTO_UPLOAD_TIMEOUT)
+            return gcs_public_url(bucket.name, blob_name)
+        except Exception as e:
+            if attempt == PHOTO_UPLOAD_RETRIES:
+                raise
+            print(f"Error in upload_photo ({blob_name}, 第 {attempt} 次): {e}")
+            time.sleep(2 ** (attempt - 1))
+
+def upload_photos(bucket, folder_path, name_prefix, photos, on_late_upload=None):
+    # 回傳 (成功的網址列表, 失敗的照片列表)，網址順序與上傳順序一致
+    # 物件名稱加上隨機碼，逾時後前端重傳的照片不會和仍在上傳的舊物件同名
+    futures = []
+    for photo in photos:
+        blob_name = f"{folder_path}{name_prefix}{uuid.uuid4().hex[:8]}_{photo.filename}"
+        futures.append((photo, blob_name, _photo_upload_executor.submit(
+            upload_photo, bucket, blob_name, photo.stream, photo.content_type
+        )))
+    # 最長等待時間：每次嘗試的逾時加上重試間隔
+    deadline = time.time() + PHOTO_UPLOAD_RETRIES * PHOTO_UPLOAD_TIMEOUT + 2 ** PHOTO_UPLOAD_RETRIES
+    uploaded, failed = [], []
+    for photo, blob_name, future in futures:
+        try:
+            uploaded.append(future.result(timeout=max(0, deadline - time.time())))
+        except FutureTimeoutError:
+            # 還在排隊的直接取消；已經開始上傳的等它結束，成功的物件交給 on_late_upload 清除，不留下沒有紀錄的照片
+            if not future.cancel() and on_late_upload:
+                future.add_done_callback(lambda f, name=blob_name: _cleanup_late_upload(f, name, on_late_upload))
+            print(f"Error in upload_photos ({photo.filename}): 上傳逾時")
+            failed.append({"filename": photo.filename, "error": "upload timed out"})
+        except Exception as e:
+            print(f"Error in upload_photos ({photo.filename}): {e}")
+            failed.append({"filename": photo.filename, "error": str(e) or type(e).__name__})
+    return uploaded, failed
+
+def _cleanup_late_upload(future, blob_name, on_late_upload):
+    if future.exception() is not None:
+        return
+    try:
+        on_late_upload([blob_name])
+    except Exception as e:
+        print(f"Error in _cleanup_late_upload ({blob_name}): {e}")
+
+#-----------------------------------直傳 GCS 的簽署網址
+# 前端拿到 V4 簽署網址後直接 PUT 到 GCS，照片位元組不經過 Flask
+SIGNED_UPLOAD_EXPIRES_SECONDS = 15 * 60
+
+def safe_photo_filename(filename):
+    name = os.path.basename(filename or '').strip() or 'photo'
+    return re.sub(r'[^\w.\-]', '_', name)[-100:]
+
+def generate_upload_url(bucket, blob_name, content_type, expires_seconds=SIGNED_UPLOAD_EXPIRES_SECONDS):
+    blob = bucket.blob(blob_name)
+    with metrics.track('gcs', 'sign_url'):
+        return blob.generate_signed_url(
+            version='v4',
+            expiration=timedelta(seconds=expires_seconds),
+            method='PUT',
+            content_type=content_type
+        )
+
+def existing_blob_names(bucket, prefix):
+    # 一次列出資料夾內的物件，用來確認前端回報的上傳是否真的完成
+    with metrics.track('gcs', 'list'):
+        return {blob.name for blob in bucket.list_blobs(prefix=prefix)}
+
+#-----------------------------------打卡紀錄分頁查詢
+# 打卡存放在獨立集合，以 (user_id, ts, _id) 索引；分頁游標為最後一筆的 (ts, _id)
+CHECKIN_PAGE_DEFAULT_LIMIT = 20
+CHECKIN_PAGE_MAX_LIMIT = 100
+CHECKIN_FIELDS = (
+    'checkinId', 'checkinName', 'latitude', 'longitude', 'timestamp',
+    'photos', 'description', 'palseCheckin', 'linkedPlace'
+)
+
+def checkin_utc_time(timestamp):
+    # 打卡的 timestamp 是台北時間字串，轉成 UTC 存進 ts 欄位供排序與區間查詢
+    try:
+        return datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%f%z').astimezone(timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return datetime(1970, 1, 1)
+
+def parse_time_filter(value):
+    # ISO 8601 字串，沒有時區時視為 UTC；格式錯誤時拋出 ValueError
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def checkin_document(user_id, record):
+    return {"_id": record['checkinId'], "user_id": user_id, "ts": checkin_utc_time(record.get('timestamp')), **record}
+
+def encode_checkin_cursor(doc):
+    raw = json.dumps([doc['ts'].isoformat(), doc['_id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_checkin_cursor(cursor):
+    # 游標格式錯誤時拋出 ValueError
+    try:
+        ts, checkin_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return datetime.fromisoformat(ts), checkin_id
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def checkin_page_query(user_id, since=None, until=None, after=None, descending=False):
+    query = {"user_id": user_id}
+    ts_range = {}
+    if since:
+        ts_range["$gte"] = since
+    if until:
+        ts_range["$lt"] = until
+    if ts_range:
+        query["ts"] = ts_range
+    if after:
+        ts, checkin_id = after
+        op = "$lt" if descending else "$gt"
+        query["$or"] = [{"ts": {op: ts}}, {"ts": ts, "_id": {op: checkin_id}}]
+    return query
+
+def checkin_projection(fields=None):
+    # _id 與 ts 供產生游標，回傳前再移除；要照片時一併帶出縮圖資訊
+    if not fields:
+        return {"user_id": 0}
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    projection = {"_id": 1, "ts": 1, "checkinId": 1}
+    for field in fields:
+        if field in CHECKIN_FIELDS:
+            projection[field] = 1
+    if 'photos' in projection:
+        projection['photo_variants'] = 1
+    return projection
+
+def public_checkin(doc):
+    return {k: v for k, v in doc.items() if k not in ('_id', 'user_id', 'ts')}
+
+#-----------------------------------照片縮圖
+# 上傳完成後在背景執行緒池產生多種寬度的 WebP / JPEG 版本，套用 EXIF 方向並去除中繼資料
+PHOTO_VARIANT_WIDTHS = (320, 640, 1280)
+PHOTO_VARIANT_FORMATS = (('webp', 'WEBP', 'image/webp'), ('jpeg', 'JPEG', 'image/jpeg'))
+PHOTO_VARIANT_QUALITY = 80
+PHOTO_PROCESSING_WORKERS = 2
+
+_photo_processing_executor = ThreadPoolExecutor(max_workers=PHOTO_PROCESSING_WORKERS, thread_name_prefix='photo-variants')
+
+def blob_name_from_url(bucket_name, url):
+    return url.split(f"https://storage.googleapis.com/{bucket_name}/")[-1]
+
+def variant_blob_name(blob_name, width, extension):
+    folder, _, filename = blob_name.rpartition('/')
+    stem = filename.rsplit('.', 1)[0] if '.' in filename else filename
+    return f"{folder}/variants/{stem}_{width}.{extension}"
+
+def generate_photo_variants(bucket, blob_name):
+    with metrics.track('gcs', 'download'):
+        data = bucket.blob(blob_name).download_as_bytes()
+    image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    variants = []
+    for width in PHOTO_VARIANT_WIDTHS:
+        # 不放大原圖；原圖比最小尺寸還小時仍保留一份轉檔後的版本
+        if width > image.width and variants:
+            break
+        resized = image.copy()
+        resized.thumbnail((width, width * 10), Image.LANCZOS)
+        for extension, pil_format, content_type in PHOTO_VARIANT_FORMATS:
+            buffer = BytesIO()
+            resized.save(buffer, format=pil_format, quality=PHOTO_VARIANT_QUALITY)  # 不帶 exif 參數即去除中繼資料
+            name = variant_blob_name(blob_name, width, extension)
+            with metrics.track('gcs', 'upload'):
+                bucket.blob(name).upload_from_string(buffer.getvalue(), content_type=content_type)
+            variants.append({
+                "width": resized.width,
+                "height": resized.height,
+                "format": extension,
+                "url": gcs_public_url(bucket.name, name)
+            })
+    return variants
+
+def _process_photo(bucket, photo_url, record):
+    try:
+        variants = generate_photo_variants(bucket, blob_name_from_url(bucket.name, photo_url))
+        record(photo_url, variants)
+    except Exception as e:
+        print(f"Error in generate_photo_variants ({photo_url}): {e}")
+
+def schedule_photo_variants(bucket, photo_urls, record):
+    # record(photo_url, variants) 由呼叫端負責把結果寫回資料庫
+    for photo_url in photo_urls:
+        _photo_processing_executor.submit(_process_photo, bucket, photo_url, record)
+
+def pick_photo_variant(photo_url, variants, view_width=None, preferred_format='webp'):
+    # 挑出寬度足以填滿畫面的最小版本，沒有縮圖時回傳原圖
+    candidates = [v for v in variants or [] if v['format'] == preferred_format] or list(variants or [])
+    if not candidates:
+        return photo_url
+    candidates.sort(key=lambda v: v['width'])
+    if view_width:
+        for variant in candidates:
+            if variant['width'] >= view_width:
+                return variant['url']
+        return photo_url  # 所有縮圖都比畫面窄時直接用原圖，不把小圖放大顯示
+    return candidates[0]['url']
+
+def attach_display_photos(checkin, view_width=None, preferred_format='webp'):
+    variants_by_url = {item['url']: item['variants'] for item in checkin.get('photo_variants', [])}
+    checkin['displayPhotos'] = [
+        pick_photo_variant(url, variants_by_url.get(url), view_width, preferred_format)
+        for url in checkin.get('photos', [])
+    ]
+    return checkin
+
+#-----------------------------------景點詳細資料快取
+# 以 (place_id, 語言, 欄位) 為鍵快取 Place Details 回應，同一鍵同時間的請求只呼叫 Google 一次
+PLACE_DETAILS_URL = "https://maps.googleapis.com/maps/api/place/details/json"
+PLACE_DETAILS_CACHE_TTL_SECONDS = 6 * 3600
+PLACE_DETAILS_CACHE_MAX_ENTRIES = 5000
+PLACE_DETAILS_MAX_BATCH = 20
+
+class SingleFlight:
+    # 同一個 key 正在執行時，後到的呼叫等待並共用第一個呼叫的結果或例外
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result()
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+        return future.result()
+
+def normalize_place_fields(fields):
+    if not fields:
+        return ''
+    if isinstance(fields, str):
+        fields = fields.split(',')
+    return ','.join(sorted({field.strip() for field in fields if field.strip()}))
+
+class PlaceDetailsCache:
+    def __init__(self, session, ttl_seconds=PLACE_DETAILS_CACHE_TTL_SECONDS, max_entries=PLACE_DETAILS_CACHE_MAX_ENTRIES):
+        self.session = session
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self.flight = SingleFlight()
+
+    def _fetch(self, key, place_id, api_key, language, fields):
+        params = {"place_id": place_id, "key": api_key, "language": language}
+        if fields:
+            params["fields"] = fields
+        response = self.session.get(PLACE_DETAILS_URL, params=params)
+        body = response.json()
+        # 只快取成功的結果，配額或暫時性錯誤下次重新查詢
+        if response.status_code == 200 and body.get('status') == 'OK':
+            self.memory.set(key, body)
+        return response.status_code, body
+
+    def get(self, place_id, api_key, language='zh-TW', fields=None):
+        # 回傳 (HTTP 狀態碼, Google 回應內容)
+        fields = normalize_place_fields(fields)
+        # 鍵值包含 API 金鑰的雜湊，不同金鑰不會共用快取或同一次查詢，無效金鑰也拿不到別人的結果
+        key_hash = hashlib.sha1(str(api_key).encode('utf-8')).hexdigest()[:16]
+        key = f"{key_hash}|{place_id}|{language}|{fields}"
+        body = self.memory.get(key)
+        if body is not None:
+            return 200, body
+        return self.flight.do(key, lambda: self._fetch(key, place_id, api_key, language, fields))
+
+#-----------------------------------LINE webhook 重送去重
+# LINE 沒收到 200 會重送同一個 webhookEventId，先查記憶體 LRU，
+# 再把事件 ID 當 _id 寫入 MongoDB，多個程序同時收到也只有一個會處理
+WEBHOOK_EVENT_TTL_SECONDS = 24 * 3600
+WEBHOOK_DEDUPE_MAX_ENTRIES = 10000
+REPLY_TOKEN_TTL_SECONDS = 60
+
+class WebhookEventDeduper:
+    def __init__(self, collection, ttl_seconds=WEBHOOK_EVENT_TTL_SECONDS, max_entries=WEBHOOK_DEDUPE_MAX_ENTRIES):
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.collection.create_index('received_at', expireAfterSeconds=self.ttl_seconds)
+
+    def claim(self, event_id):
+        # 第一次看到這個事件回傳 True；沒有事件 ID 時一律處理
+        if not event_id:
+            return True
+        with self._lock:
+            if self.memory.get(event_id):
+                return False
+            self.memory.set(event_id, True)
+        try:
+            self.collection.insert_one({"_id": event_id, "received_at": datetime.utcnow()})
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            # MongoDB 無法使用時只靠記憶體去重，寧可重複處理也不要漏掉事件
+            print(f"Error in WebhookEventDeduper.claim: {e}")
+        return True
+
+def reply_token_expired(event_timestamp_ms, ttl_seconds=REPLY_TOKEN_TTL_SECONDS):
+    return time.time() - event_timestamp_ms / 1000 > ttl_seconds
+
+#-----------------------------------GCS 刪除佇列
+# 要刪除的物件先寫進 MongoDB outbox，背景執行緒再以 GCS batch 請求批次刪除，
+# 以物件名稱當 _id 確保重複排入也只會刪一次，失敗時依指數退避重試
+GCS_DELETE_BATCH_SIZE = 100  # GCS 單次 batch 請求最多 100 個操作
+GCS_DELETE_POLL_SECONDS = 5
+GCS_DELETE_LEASE_SECONDS = 120
+GCS_DELETE_MAX_ATTEMPTS = 8
+
+class _DeferredBatch(Exception):
+    # 在 batch 區塊內拋出時，離開區塊不會自動送出，改由呼叫端明確呼叫 finish() 取得回應
+    pass
+
+class GcsDeleteOutbox:
+    def __init__(self, collection, gcs_client, bucket):
+        self.collection = collection
+        self.gcs_client = gcs_client
+        self.bucket = bucket
+        self._thread = None
+
+    def ensure_indexes(self):
+        self.collection.create_index("next_attempt_at")
+
+    def enqueue(self, blob_names):
+        now = datetime.utcnow()
+        operations = [
+            UpdateOne(
+                {"_id": name},
+                {"$setOnInsert": {"created_at": now, "attempts": 0, "next_attempt_at": now}},
+                upsert=True
+            )
+            for name in dict.fromkeys(blob_names)
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def _claim(self):
+        # 以租約標記取出的項目，多個程序同時清理時不會重複處理
+        now = datetime.utcnow()
+        ids = [doc['_id'] for doc in self.collection.find(
+            {"next_attempt_at": {"$lte": now}}, {"_id": 1}
+        ).limit(GCS_DELETE_BATCH_SIZE)]
+        if not ids:
+            return []
+        lease = uuid.uuid4().hex
+        self.collection.update_many(
+            {"_id": {"$in": ids}, "next_attempt_at": {"$lte": now}},
+            {"$set": {"lease": lease, "next_attempt_at": now + timedelta(seconds=GCS_DELETE_LEASE_SECONDS)}}
+        )
+        return list(self.collection.find({"_id": {"$in": ids}, "lease": lease}, {"_id": 1, "attempts": 1}))
+
+    def drain_once(self):
+        docs = self._claim()
+        if not docs:
+            return 0
+        try:
+            try:
+                with self.gcs_client.batch(raise_exception=False) as batch:
+                    for doc in docs:
+                        self.bucket.delete_blob(doc['_id'])
+                    raise _DeferredBatch()
+            except _DeferredBatch:
+                pass
+            with metrics.track('gcs', 'batch_delete'):
+                responses = batch.finish(raise_exception=False)
+            # 每個子請求的回應依排入順序排列；404 代表已經刪除，同樣視為成功
+            statuses = [response.status_code for response in responses]
+        except Exception as e:
+            print(f"Error in GcsDeleteOutbox.drain_once: {e}")
+            statuses = [None] * len(docs)
+
+        done = [doc['_id'] for doc, status in zip(docs, statuses) if status is not None and (200 <= status < 300 or status == 404)]
+        if done:
+            self.collection.delete_many({"_id": {"$in": done}})
+        now = datetime.utcnow()
+        for doc, status in zip(docs, statuses):
+            if doc['_id'] in done:
+                continue
+            attempts = doc.get('attempts', 0) + 1
+            # 超過重試上限就停止排程，保留紀錄供人工檢查
+            next_attempt_at = now + timedelta(seconds=2 ** attempts * 10) if attempts < GCS_DELETE_MAX_ATTEMPTS else None
+            self.collection.update_one(
+                {"_id": doc['_id']},
+                {"$set": {"attempts": attempts, "next_attempt_at": next_attempt_at, "last_status": status},
+                 "$unset": {"lease": ""}}
+            )
+        return len(docs)
+
+    def _run(self):
+        while True:
+            try:
+                processed = self.drain_once()
+            except Exception as e:
+                print(f"Error in GcsDeleteOutbox._run: {e}")
+                processed = 0
+            if processed < GCS_DELETE_BATCH_SIZE:
+                time.sleep(GCS_DELETE_POLL_SECONDS)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='gcs-delete-outbox', daemon=True)
+            self._thread.start()
+
+def checkin_blob_names(bucket_name, checkin, photo_urls=None):
+    # 打卡照片與其縮圖在 GCS 上的物件名稱
+    photo_urls = checkin.get('photos', []) if photo_urls is None else photo_urls
+    names = [blob_name_from_url(bucket_name, url) for url in photo_urls]
+    for item in checkin.get('photo_variants', []):
+        if item['url'] in photo_urls:
+            names.extend(blob_name_from_url(bucket_name, variant['url']) for variant in item['variants'])
+    return names
+
+#-----------------------------------推薦結果快取
+# 以 (縣市, 候選景點集合雜湊, prompt 版本) 為鍵，每個鍵保留多組不同的 Gemini 挑選結果，
+# 池子滿了之後隨機回傳其中一組，使用者之間仍有變化但大多數請求不必呼叫 LLM
+RECOMMENDATION_PROMPT_VERSION = 2
+RECOMMENDATION_POOL_SIZE = 5
+RECOMMENDATION_CACHE_TTL_SECONDS = 24 * 3600
+RECOMMENDATION_CACHE_MAX_KEYS = 500
+
+def candidate_set_hash(places):
+    place_ids = sorted(place['place_id'] for place in places)
+    return hashlib.sha1('|'.join(place_ids).encode('utf-8')).hexdigest()
+
+class RecommendationCache:
+    def __init__(self, pool_size=RECOMMENDATION_POOL_SIZE, ttl_seconds=RECOMMENDATION_CACHE_TTL_SECONDS,
+                 max_keys=RECOMMENDATION_CACHE_MAX_KEYS):
+        self.pool_size = pool_size
+        self.ttl_seconds = ttl_seconds
+        self._pools = LRUCache(max_keys, ttl_seconds)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(city_name, places, prompt_version=RECOMMENDATION_PROMPT_VERSION):
+        return (city_name, candidate_set_hash(places), prompt_version)
+
+    def get(self, key):
+        # 池子還沒收集滿時回傳 None，讓呼叫端再問一次 Gemini 以增加變化
+        entry = self._pools.get(key)
+        with self._lock:
+            if entry and len(entry[1]) >= self.pool_size:
+                self.hits += 1
+                return [dict(place) for place in random.choice(entry[1])]
+            self.misses += 1
+            return None
+
+    def add(self, key, selection):
+        signature = tuple(sorted(place.get('place_id', '') for place in selection))
+        with self._lock:
+            entry = self._pools.get(key)
+            created_at, pool = entry if entry else (time.time(), [])
+            if signature in {tuple(sorted(p.get('place_id', '') for p in s)) for s in pool}:
+                return
+            if len(pool) >= self.pool_size:
+                return
+            pool = pool + [[dict(place) for place in selection]]
+            # TTL 從池子建立時開始計算，不會因為持續加入而無限延長
+            remaining = self.ttl_seconds - (time.time() - created_at)
+            if remaining > 0:
+                self._pools.set(key, (created_at, pool), ttl_seconds=remaining)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "keys": len(self._pools),
+                "pool_size": self.pool_size
+            }
+
+#-----------------------------------精簡的 Gemini 推薦輸入輸出
+# 候選景點只送「編號|名稱」，模型只回傳編號陣列，伺服器端再從候選清單還原完整景點
+RECOMMENDATION_PICK_COUNT = 5
+RECOMMENDATION_PROMPT = '''從以下候選景點（格式：編號|名稱）挑選{count}個推薦且值得拜訪的景點。
+不要只從前面開始選，每次都可以不一樣；名稱只是縣市名稱、停車場或廁所的不要選。
+只回傳挑選景點編號的JSON陣列，依你建議的拜訪順序排列。
+'''
+RECOMMENDATION_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {"type": "integer"}
+}
+
+def compact_recommendation_prompt(places_list, count=RECOMMENDATION_PICK_COUNT):
+    lines = [f"{i}|{place['name']}" for i, place in enumerate(places_list)]
+    return RECOMMENDATION_PROMPT.format(count=count) + '\n'.join(lines)
+
+def rehydrate_selection(text, places_list, count=RECOMMENDATION_PICK_COUNT):
+    # 忽略超出範圍或重複的編號；一個有效編號都沒有時拋出 ValueError
+    indices = json.loads(text)
+    if not isinstance(indices, list):
+        raise ValueError('Gemini 回應不是陣列')
+    selected = []
+    seen = set()
+    for index in indices:
+        if isinstance(index, int) and 0 <= index < len(places_list) and index not in seen:
+            seen.add(index)
+            selected.append(dict(places_list[index]))
+        if len(selected) >= count:
+            break
+    if not selected:
+        raise ValueError('Gemini 回應沒有有效的景點編號')
+    return selected
+
+def gemini_usage_summary(response, latency):
+    usage = getattr(response, 'usage_metadata', None)
+    return {
+        "prompt_tokens": getattr(usage, 'prompt_token_count', None),
+        "output_tokens": getattr(usage, 'candidates_token_count', None),
+        "total_tokens": getattr(usage, 'total_token_count', None),
+        "latency_ms": round(latency * 1000, 1)
+    }
+
+#-----------------------------------有時限的多階段流程
+# 每個階段在執行緒池上執行，等待時間取「階段預算」與「整體剩餘時間」較小者
+# 逾時的階段無法中斷，會在背景跑完後丟棄結果
+class PipelineError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class StageRunner:
+    def __init__(self, executor, deadline_seconds):
+        self.executor = executor
+        self.started = time.monotonic()
+        self.deadline = self.started + deadline_seconds
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def wait(self, stage, future, budget_seconds):
+        timeout = min(budget_seconds, self.remaining())
+        if timeout <= 0:
+            future.cancel()
+            raise PipelineError(504, f'{stage}超過整體時限')
+        stage_started = time.monotonic()
+        try:
+            result = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise PipelineError(504, f'{stage}逾時')
+        print(f"{stage}完成，耗時 {time.monotonic() - stage_started:.2f} 秒")
+        return result
+
+    def run(self, stage, budget_seconds, fn, *args):
+        return self.wait(stage, self.submit(fn, *args), budget_seconds)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
 #-----------------------------------計算查找最佳路線
-def find_best_route(distances, places):
-    num_places = len(places)  # 獲取地點數量
-    indices = list(range(num_places))  # 創建一個地點索引的列表 [0, 1, 2, ...]
-    min_distance = float('inf')  # 初始化最小距離為正無窮大
-    best_permutation = indices  # 初始化最佳排列為地點的原始順序
-    cache = {}  # 初始化一個字典用來緩存計算過的排列組合的總距離
-
-    def calculate_total_distance(permutation):
-        # 如果該排列組合的距離已經計算過，直接從緩存中獲取
-        if permutation in cache:
-            return cache[permutation]
-        
-        # 計算該排列組合的總距離
-        total_distance = sum(distances[permutation[i]][permutation[i+1]] for i in range(len(permutation) - 1))
-        
-        # 將計算結果存入緩存中
-        cache[permutation] = total_distance
-        return total_distance
+# 依地點數量挑選求解策略：少量地點用 Held-Karp 位元遮罩動態規劃求精確解，
+# 地點較多時改用最近鄰建構 + 2-opt / Or-opt 局部搜尋求近似解
+HELD_KARP_MAX_PLACES = 12
+LOCAL_SEARCH_MAX_ROUNDS = 50
+LOCAL_SEARCH_MAX_STARTS = 8
 
-    # 遍歷所有地點的所有排列組合
-    for permutation in itertools.permutations(indices):
-        total_distance = calculate_total_distance(permutation)  # 計算當前排列的總距離
-        
-        # 如果當前排列的總距離小於已知最小距離，則更新最小距離和最佳排列
-        if total_distance < min_distance:
-            min_distance = total_distance
-            best_permutation = permutation
+def route_cost(distances, order, closed=False):
+    cost = sum(distances[order[i]][order[i + 1]] for i in range(len(order) - 1))
+    if closed and len(order) > 1:
+        cost += distances[order[-1]][order[0]]
+    return cost
+
+def solve_route_held_karp(distances, num_places, start=None, end=None, closed=False):
+    full_mask = (1 << num_places) - 1
+    inf = float('inf')
+    # dp[mask][j]：從起點出發、走過 mask 內所有地點並停在 j 的最短距離
+    dp = [[inf] * num_places for _ in range(1 << num_places)]
+    parent = [[-1] * num_places for _ in range(1 << num_places)]
+
+    if closed:
+        starts = [start if start is not None else 0]  # 封閉路線任一點都可當起點
+    elif start is not None:
+        starts = [start]
+    else:
+        starts = [i for i in range(num_places) if i != end or num_places == 1]
+    for s in starts:
+        dp[1 << s][s] = 0
+
+    for mask in range(1, full_mask + 1):
+        row = dp[mask]
+        for j in range(num_places):
+            cost = row[j]
+            if cost == inf:
+                continue
+            dist_row = distances[j]
+            for k in range(num_places):
+                if mask & (1 << k):
+                    continue
+                next_mask = mask | (1 << k)
+                # 固定終點只能在最後一步抵達
+                if not closed and k == end and next_mask != full_mask:
+                    continue
+                new_cost = cost + dist_row[k]
+                if new_cost < dp[next_mask][k]:
+                    dp[next_mask][k] = new_cost
+                    parent[next_mask][k] = j
+
+    ends = [end] if (end is not None and not closed) else range(num_places)
+    best_cost, best_end = inf, -1
+    for j in ends:
+        cost = dp[full_mask][j]
+        if closed:
+            cost += distances[j][starts[0]]
+        if cost < best_cost:
+            best_cost, best_end = cost, j
+
+    # 回溯出路線順序
+    order = []
+    mask, j = full_mask, best_end
+    while j != -1:
+        order.append(j)
+        prev = parent[mask][j]
+        mask ^= 1 << j
+        j = prev
+    order.reverse()
+    return order, best_cost
+
+def _nearest_neighbor_route(distances, num_places, first, end):
+    order = [first]
+    remaining = set(range(num_places)) - {first}
+    if end is not None and end != first:
+        remaining.discard(end)
+    while remaining:
+        last = order[-1]
+        nxt = min(remaining, key=lambda k: distances[last][k])
+        order.append(nxt)
+        remaining.remove(nxt)
+    if end is not None and end != first:
+        order.append(end)
+    return order
+
+def _improve_route(distances, order, lo, hi, closed):
+    # 只在 [lo, hi] 區間內調整，固定的起終點不會被移動
+    # 每個候選只計算變動到的邊，整條路線的成本只在結束時重算一次
+    n = len(order)
+
+    def edge(a, b):
+        return distances[a][b] if a is not None and b is not None else 0
+
+    def at(seq, p):
+        # 超出範圍時，封閉路線接回起點，開放路線沒有這條邊
+        if 0 <= p < len(seq):
+            return seq[p]
+        if closed and p == len(seq):
+            return seq[0]
+        return None
+
+    def prefix_sums(seq):
+        # fwd[p] / bwd[p]：前 p 條邊順向 / 反向走的距離總和，距離可能不對稱
+        fwd, bwd = [0] * len(seq), [0] * len(seq)
+        for t in range(len(seq) - 1):
+            fwd[t + 1] = fwd[t] + distances[seq[t]][seq[t + 1]]
+            bwd[t + 1] = bwd[t] + distances[seq[t + 1]][seq[t]]
+        return fwd, bwd
+
+    for _ in range(LOCAL_SEARCH_MAX_ROUNDS):
+        improved = False
+
+        # 2-opt：反轉 order[i..k]，變動的是兩端的邊與區段內每條邊的方向
+        fwd, bwd = prefix_sums(order)
+        for i in range(lo, hi):
+            for k in range(i + 1, hi + 1):
+                a, b = at(order, i - 1), at(order, k + 1)
+                delta = (edge(a, order[k]) + edge(order[i], b) + bwd[k] - bwd[i]) \
+                    - (edge(a, order[i]) + edge(order[k], b) + fwd[k] - fwd[i])
+                if delta < -1e-9:
+                    order = order[:i] + order[i:k + 1][::-1] + order[k + 1:]
+                    fwd, bwd = prefix_sums(order)
+                    improved = True
+
+        # Or-opt：把長度 1~3 的片段搬到其他位置
+        for seg_len in (1, 2, 3):
+            for i in range(lo, hi - seg_len + 2):
+                j = i + seg_len - 1
+                first, last = order[i], order[j]
+                a, b = at(order, i - 1), at(order, j + 1)
+                removed_gain = edge(a, first) + edge(last, b) - edge(a, b)
+
+                def rest_at(r):
+                    # 拿掉片段後第 r 個位置的地點
+                    if r < 0:
+                        return None
+                    if r < i:
+                        return order[r]
+                    if r < n - seg_len:
+                        return order[r + seg_len]
+                    return order[0] if closed and r == n - seg_len else None
+
+                for pos in range(lo, hi - seg_len + 2):
+                    if pos == i:
+                        continue
+                    c, e = rest_at(pos - 1), rest_at(pos)
+                    delta = edge(c, first) + edge(last, e) - edge(c, e) - removed_gain
+                    if delta < -1e-9:
+                        rest = order[:i] + order[j + 1:]
+                        order = rest[:pos] + order[i:j + 1] + rest[pos:]
+                        improved = True
+                        break
+
+        if not improved:
+            break
+    return order, route_cost(distances, order, closed)
+
+def _local_search_starts(distances, num_places, end):
+    # 沒有固定起點時不逐一嘗試每個地點，只從離其他地點最遠的幾個外圍地點出發
+    candidates = [i for i in range(num_places) if i != end]
+    candidates.sort(key=lambda i: -sum(distances[i][k] + distances[k][i] for k in range(num_places)))
+    return candidates[:LOCAL_SEARCH_MAX_STARTS]
+
+def solve_route_local_search(distances, num_places, start=None, end=None, closed=False):
+    if closed:
+        firsts = [start if start is not None else 0]
+        end = None
+    elif start is not None:
+        firsts = [start]
+    else:
+        firsts = _local_search_starts(distances, num_places, end)
+
+    lo = 1 if (closed or start is not None) else 0
+    hi = num_places - 2 if end is not None else num_places - 1
+
+    best_order, best_cost = None, float('inf')
+    for first in firsts:
+        order = _nearest_neighbor_route(distances, num_places, first, end)
+        order, cost = _improve_route(distances, order, lo, hi, closed)
+        if cost < best_cost:
+            best_order, best_cost = order, cost
+    return best_order, best_cost
+
+route_solvers = {
+    'held_karp': solve_route_held_karp,
+    'local_search': solve_route_local_search
+}
+
+def pick_route_solver(num_places):
+    if num_places <= HELD_KARP_MAX_PLACES:
+        return route_solvers['held_karp']
+    return route_solvers['local_search']
+
+def find_best_route(distances, places, start=None, end=None, closed=False, solver=None):
+    # start / end 為 places 的索引，可固定起點或終點；closed=True 代表最後要回到起點
+    num_places = len(places)
+    if num_places == 0:
+        return [], 0
+    if closed and end is not None and end != start:
+        raise ValueError("封閉路線的終點必須與起點相同")
+    if not closed and start is not None and start == end and num_places > 1:
+        raise ValueError("開放路線的起點與終點不能相同")
+    if closed:
+        end = None
+
+    if num_places == 1:
+        return list(places), 0
+
+    solve = route_solvers[solver] if solver else pick_route_solver(num_places)
+    best_order, total_distance = solve(distances, num_places, start=start, end=end, closed=closed)
+    # 求解器沒有排出包含所有地點的路線時，保留原本的順序，避免寫回不完整的行程
+    if not best_order or sorted(best_order) != list(range(num_places)) or not math.isfinite(total_distance):
+        print("路線計算失敗，保留原本的地點順序")
+        best_order = list(range(num_places))
+        total_distance = route_cost(distances, best_order, closed)
+        if not math.isfinite(total_distance):
+            total_distance = None  # 回傳給前端的 JSON 不能含 Infinity
 
     # 根據最佳排列重新排序地點
-    sorted_places = [places[i] for i in best_permutation]
-    return sorted_places
+    sorted_places = [places[i] for i in best_order]
+    return sorted_places, total_distance
+
+#-----------------------------------行程原子更新
+# 以 aggregation pipeline 在 MongoDB 端直接改寫某一天的景點陣列，不必先讀出整份行程
+def _day_expr(day_index):
+    return {"$arrayElemAt": ["$places", day_index]}
+
+def replace_day_stage(day_index, new_day):
+    return {"$set": {"places": {"$map": {
+        "input": {"$range": [0, {"$size": "$places"}]},
+        "as": "d",
+        "in": {"$cond": [{"$eq": ["$$d", day_index]}, new_day, {"$arrayElemAt": ["$places", "$$d"]}]}
+    }}}}
+
+def swap_adjacent_places_pipeline(day_index, place_index):
+    # 交換 place_index 與 place_index + 1 兩個景點
+    day = _day_expr(day_index)
+    parts = []
+    if place_index > 0:
+        parts.append({"$slice": [day, 0, place_index]})
+    parts.append([{"$arrayElemAt": [day, place_index + 1]}, {"$arrayElemAt": [day, place_index]}])
+    parts.append({"$slice": [day, place_index + 2, {"$size": day}]})
+    return [replace_day_stage(day_index, {"$concatArrays": parts})]
+
+def remove_place_pipeline(day_index, place_index):
+    day = _day_expr(day_index)
+    parts = []
+    if place_index > 0:
+        parts.append({"$slice": [day, 0, place_index]})
+    parts.append({"$slice": [day, place_index + 1, {"$size": day}]})
+    return [replace_day_stage(day_index, {"$concatArrays": parts}), place_ids_stage()]
+
+def place_ids_stage():
+    # 依修改後的 places 重新計算 place_ids，與景點異動放在同一次更新，打卡反查不必等背景同步
+    return {"$set": {"place_ids": {"$setUnion": [[], {"$filter": {
+        "input": {"$reduce": {
+            "input": {"$ifNull": ["$places", []]},
+            "initialValue": [],
+            "in": {"$concatArrays": ["$$value", {"$map": {
+                "input": {"$ifNull": ["$$this", []]}, "as": "p", "in": "$$p.place_id"
+            }}]}
+        }},
+        "as": "id",
+        "cond": {"$and": [{"$ne": ["$$id", None]}, {"$ne": ["$$id", ""]}]}
+    }}]}}}
+
+def set_day_pipeline(day_index, places):
+    # 整天的景點換成 places（以 $literal 包住，景點內容不會被當成運算式）
+    return [replace_day_stage(day_index, {"$literal": places}), place_ids_stage()]
+
+def remove_last_day_pipeline():
+    return [
+        {"$set": {
+            "days": {"$subtract": ["$days", 1]},
+            "places": {"$slice": ["$places", {"$max": [{"$subtract": [{"$size": "$places"}, 1]}, 0]}]}
+        }},
+        place_ids_stage()
+    ]
+
+def with_version_bump(update):
+    # 每次修改都遞增 version，作為樂觀鎖的版本號
+    # 同時以 MongoDB 伺服器時間記下 user_version，供使用者層級的差異同步查詢，不必另外遞增計數器
+    if isinstance(update, list):
+        return update + [{"$set": {
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+            "user_version": "$$NOW"
+        }}]
+    update = dict(update)
+    update["$inc"] = dict(update.get("$inc", {}), version=1)
+    update["$currentDate"] = dict(update.get("$currentDate", {}), user_version=True)
+    return update
+
+#-----------------------------------行程差異同步版本
+# user_version 是寫入當下的伺服器時間，同步版本以毫秒整數交給前端
+# 並行的寫入可能晚一點才被讀到，因此交出的版本不超過「現在減去 SYNC_VERSION_SETTLE_MS」，
+# 比它更早蓋上時間的寫入都已可見；較新的修改在下次差異同步時會再送一次
+SYNC_VERSION_SETTLE_MS = 5000
+SYNC_VERSION_EPOCH = datetime(1970, 1, 1)
 
-def get_places_by_city(gmaps, city_name, place_type='tourist_attraction', language='zh-TW', max_places=30):
+def sync_version_datetime(version):
+    return SYNC_VERSION_EPOCH + timedelta(milliseconds=version)
+
+def sync_version_pipeline(user_id, tombstone_collection, settle_ms=SYNC_VERSION_SETTLE_MS):
+    # 在 itineraries 上執行：取行程與墓碑中最新的 user_version（走 (user_id, user_version) 索引），一次往返算出同步版本
+    latest = [
+        {"$match": {"user_id": user_id}},
+        {"$sort": {"user_version": -1}},
+        {"$limit": 1},
+        {"$project": {"_id": 0, "user_version": 1}}
+    ]
+    return latest + [
+        {"$unionWith": {"coll": tombstone_collection, "pipeline": latest}},
+        {"$group": {"_id": None, "latest": {"$max": "$user_version"}}},
+        {"$project": {"_id": 0, "version": {"$min": [
+            {"$ifNull": [{"$toLong": "$latest"}, 0]},  # 舊資料沒有 user_version 時視為 0
+            {"$subtract": [{"$toLong": "$$NOW"}, settle_ms]}
+        ]}}}
+    ]
+
+def version_condition(version):
+    # 舊資料沒有 version 欄位，視為版本 0
+    return version if version else {"$in": [0, None]}
+
+#-----------------------------------批次套用行程操作
+ITINERARY_BATCH_MAX_OPERATIONS = 200
+
+def apply_itinerary_operations(itinerary, operations):
+    # 在記憶體中依序重播所有操作並一起驗證，任何一筆不合法就整批拒絕（ValueError）
+    places = [list(day) for day in itinerary.get('places', [])]
+    days = itinerary.get('days', len(places))
+
+    def get_index(operation, key, upper):
+        value = operation.get(key)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0 or value >= upper:
+            raise ValueError(f"{key} 無效")
+        return value
+
+    for i, operation in enumerate(operations):
+        op = operation.get('op')
+        try:
+            if op == 'add_place':
+                day_index = get_index(operation, 'day_index', len(places))
+                if not operation.get('place'):
+                    raise ValueError("缺少地點信息")
+                position = operation.get('position')
+                if position is None:
+                    places[day_index].append(operation['place'])
+                else:
+                    places[day_index].insert(get_index(operation, 'position', len(places[day_index]) + 1), operation['place'])
+            elif op == 'move_place':
+                day_index = get_index(operation, 'day_index', len(places))
+                day = places[day_index]
+                place_index = get_index(operation, 'place_index', len(day))
+                direction = operation.get('direction')
+                if direction == 'up' and place_index > 0:
+                    day.insert(place_index - 1, day.pop(place_index))
+                elif direction == 'down' and place_index < len(day) - 1:
+                    day.insert(place_index + 1, day.pop(place_index))
+                else:
+                    raise ValueError("移動方向無效或位置錯誤")
+            elif op == 'delete_place':
+                day_index = get_index(operation, 'day_index', len(places))
+                places[day_index].pop(get_index(operation, 'place_index', len(places[day_index])))
+            elif op == 'add_day':
+                places.append([])
+                days += 1
+            elif op == 'remove_day':
+                if days <= 1:
+                    raise ValueError("行程天數不能少於1天")
+                if places:
+                    places.pop()
+                days -= 1
+            else:
+                raise ValueError(f"不支援的操作 {op}")
+        except ValueError as e:
+            raise ValueError(f"第 {i + 1} 個操作錯誤: {e}")
+    return places, days
+
+def get_places_by_city(gmaps, city_name, place_type='tourist_attraction', language='zh-TW', max_places=30, paginate=True):
+    # paginate=False 只取第一頁，不需等待 next_page_token 生效
     try:
         query = f'{place_type} in {city_name}'
         places_result = gmaps.places(query=query, language=language)
         places = places_result['results']
         total_places = len(places)
         
-        while 'next_page_token' in places_result and total_places < max_places:
+        while paginate and 'next_page_token' in places_result and total_places < max_places:
             next_page_token = places_result['next_page_token']
+            # next_page_token 要等一段時間才生效，只在目錄預熱或背景更新時走到這裡
             time.sleep(2)
             places_result = gmaps.places(query=query, language=language, page_token=next_page_token)
             places.extend(places_result['results'])
@@ -122,7 +1726,213 @@ def filter_high_rated_places(places, min_rating=4.0):
         print(f"Error in filter_high_rated_places: {e}")
         return []
 
+#-----------------------------------縣市景點目錄
+# 每個 (縣市, 景點類型) 的 Places 搜尋結果存進 MongoDB，推薦時直接用索引查詢評分
+# 目錄過期時先回傳舊資料並在背景更新；完全沒有資料時只取第一頁，再於背景補齊
+TAIWAN_CITIES = [
+    '台北市', '新北市', '基隆市', '桃園市', '新竹市', '新竹縣', '苗栗縣',
+    '台中市', '彰化縣', '南投縣', '雲林縣', '嘉義市', '嘉義縣', '台南市',
+    '高雄市', '屏東縣', '宜蘭縣', '花蓮縣', '台東縣', '澎湖縣', '金門縣', '連江縣'
+]
+PLACE_CATALOG_MAX_PLACES = 60
+PLACE_CATALOG_REFRESH_SECONDS = 7 * 24 * 3600
+PLACE_CATALOG_FIELDS = ('place_id', 'name', 'geometry', 'formatted_address', 'vicinity', 'rating', 'user_ratings_total', 'types')
+
+class PlaceCatalog:
+    def __init__(self, collection, meta_collection, gmaps, refresh_seconds=PLACE_CATALOG_REFRESH_SECONDS,
+                 max_places=PLACE_CATALOG_MAX_PLACES, language='zh-TW'):
+        self.collection = collection
+        self.meta_collection = meta_collection
+        self.gmaps = gmaps
+        self.refresh_seconds = refresh_seconds
+        self.max_places = max_places
+        self.language = language
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='place-catalog')
+
+    def ensure_indexes(self):
+        self.collection.create_index([("city", 1), ("place_type", 1), ("rating", -1)])
+
+    @staticmethod
+    def _catalog_id(city_name, place_type):
+        return f"{city_name}|{place_type}"
+
+    def refresh(self, city_name, place_type='tourist_attraction', paginate=True):
+        # 寫入新結果後刪掉這次沒再出現的舊景點（例如已歇業）
+        places = get_places_by_city(self.gmaps, city_name, place_type, self.language, self.max_places, paginate)
+        if not places:
+            return []
+        fetched_at = datetime.utcnow()
+        operations = []
+        for rank, place in enumerate(places):
+            doc = {field: place[field] for field in PLACE_CATALOG_FIELDS if field in place}
+            doc.update({
+                "city": city_name,
+                "place_type": place_type,
+                "rating": place.get('rating', 0),
+                "rank": rank,
+                "fetched_at": fetched_at
+            })
+            operations.append(UpdateOne(
+                {"_id": f"{self._catalog_id(city_name, place_type)}|{place['place_id']}"},
+                {"$set": doc},
+                upsert=True
+            ))
+        self.collection.bulk_write(operations, ordered=False)
+        if paginate:
+            self.collection.delete_many({"city": city_name, "place_type": place_type, "fetched_at": {"$lt": fetched_at}})
+        self.meta_collection.update_one(
+            {"_id": self._catalog_id(city_name, place_type)},
+            {"$set": {
+                "refreshed_at": fetched_at,
+                "complete": paginate,
+                "count": len(places)
+            }},
+            upsert=True
+        )
+        return places
+
+    def _refresh_in_background(self, city_name, place_type):
+        key = self._catalog_id(city_name, place_type)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(city_name, place_type)
+            except Exception as e:
+                print(f"Error in PlaceCatalog refresh {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(run)
+
+    def high_rated_places(self, city_name, place_type='tourist_attraction', min_rating=4.0, max_places=30):
+        try:
+            meta = self.meta_collection.find_one({"_id": self._catalog_id(city_name, place_type)})
+            if meta is None:
+                # 冷啟動：即時只抓第一頁回應這次請求，完整目錄在背景建立
+                places = self.refresh(city_name, place_type, paginate=False)
+                self._refresh_in_background(city_name, place_type)
+                return filter_high_rated_places(places, min_rating)[:max_places]
+
+            if not meta.get('complete') or datetime.utcnow() - meta['refreshed_at'] > timedelta(seconds=self.refresh_seconds):
+                self._refresh_in_background(city_name, place_type)
+
+            docs = list(self.collection.find(
+                {"city": city_name, "place_type": place_type, "rating": {"$gte": min_rating}},
+                {"_id": 0, "city": 0, "place_type": 0, "fetched_at": 0}
+            ))
+            docs.sort(key=lambda doc: doc.get('rank', 0))
+            return docs[:max_places]
+        except Exception as e:
+            print(f"Error in PlaceCatalog.high_rated_places: {e}")
+            return filter_high_rated_places(get_places_by_city(self.gmaps, city_name, place_type, self.language, max_places), min_rating)
+
+#-----------------------------------已存景點的地理查詢
+# 每個已存景點鏡像成一筆 GeoJSON Point 文件，配合 2dsphere 索引用 $geoNear 查詢
+NEARBY_DEFAULT_RADIUS_KM = 1
+NEARBY_MAX_RADIUS_KM = 50
+NEARBY_DEFAULT_LIMIT = 50
+NEARBY_MAX_LIMIT = 200
+
+def ensure_place_location_indexes(collection):
+    collection.create_index([("user_id", 1), ("location", "2dsphere")])
+    collection.create_index("itinerary_id")
+
+def place_location_docs(user_id, itinerary):
+    docs = []
+    for day_index, day in enumerate(itinerary.get('places', [])):
+        for place_index, place in enumerate(day):
+            try:
+                coordinates = [float(place['longitude']), float(place['latitude'])]
+            except (KeyError, TypeError, ValueError):
+                continue
+            docs.append({
+                "_id": f"{itinerary['itinerary_id']}:{day_index}:{place_index}",
+                "user_id": user_id,
+                "itinerary_id": itinerary['itinerary_id'],
+                "day_index": day_index,
+                "place_id": place.get('place_id'),
+                "place": place,
+                "location": {"type": "Point", "coordinates": coordinates}
+            })
+    return docs
+
+def itinerary_place_ids(itinerary):
+    # 行程中所有景點的 place_id，存成多鍵索引欄位 place_ids 供打卡反查
+    return sorted({
+        place['place_id']
+        for day in itinerary.get('places', [])
+        for place in day
+        if place.get('place_id')
+    })
+
+def sync_place_locations(collection, user_id, itinerary):
+    # 以整個行程為單位重建鏡像，行程的寫入端只需在異動後呼叫一次
+    # _id 由行程、天數與順序決定，重複或交錯的同步只會覆寫同一筆文件；最後刪除這次沒寫到的舊文件
+    docs = place_location_docs(user_id, itinerary)
+    if docs:
+        collection.bulk_write([ReplaceOne({"_id": doc['_id']}, doc, upsert=True) for doc in docs], ordered=False)
+    collection.delete_many({"itinerary_id": itinerary['itinerary_id'], "_id": {"$nin": [doc['_id'] for doc in docs]}})
+
+def find_nearby_places_indexed(collection, user_id, lat, lng, radius_km, limit):
+    pipeline = [
+        {"$geoNear": {
+            "near": {"type": "Point", "coordinates": [float(lng), float(lat)]},
+            "key": "location",
+            "distanceField": "distance",
+            "maxDistance": radius_km * 1000,
+            "query": {"user_id": user_id},
+            "spherical": True
+        }},
+        {"$limit": limit},
+        {"$project": {"_id": 0, "place": 1}}
+    ]
+    return [doc['place'] for doc in collection.aggregate(pipeline)]
+
+def find_nearby_places_in_memory(places, lat, lng, radius_km, limit):
+    # 沒有地理索引時的備援：一次算完整批景點的球面距離，再依距離排序取前 limit 筆
+    lat_r = math.radians(float(lat))
+    lng_r = math.radians(float(lng))
+    cos_lat = math.cos(lat_r)
+    coords = []
+    for place in places:
+        try:
+            coords.append((place, math.radians(float(place['latitude'])), math.radians(float(place['longitude']))))
+        except (KeyError, TypeError, ValueError):
+            continue
+    distances = [
+        2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(
+            math.sin((p_lat - lat_r) / 2) ** 2 + cos_lat * math.cos(p_lat) * math.sin((p_lng - lng_r) / 2) ** 2
+        )))
+        for _, p_lat, p_lng in coords
+    ]
+    nearby = sorted(
+        ((distance, i) for i, distance in enumerate(distances) if distance <= radius_km)
+    )
+    return [coords[i][0] for _, i in nearby[:limit]]
+
 def is_nearby(place_lat, place_lng, checkin_lat, checkin_lng, distance_km=1):
     place_coords = (place_lat, place_lng)
     checkin_coords = (checkin_lat, checkin_lng)
     return geodesic(place_coords, checkin_coords).km <= distance_km
+
+#-----------------------------------MongoDB 索引與查詢計畫檢查
+def ensure_collection_indexes(collection, specs):
+    # specs 為 [(索引鍵, create_index 參數)]；索引已存在且定義相同時 create_index 不會重建
+    for keys, options in specs:
+        collection.create_index(keys, **options)
+
+def find_collscans(explain):
+    # 遞迴走訪 explain 結果（含 aggregate 的 $cursor 階段），略過被淘汰的計畫
+    if isinstance(explain, dict):
+        found = 1 if explain.get('stage') == 'COLLSCAN' else 0
+        return found + sum(find_collscans(value) for key, value in explain.items() if key != 'rejectedPlans')
+    if isinstance(explain, list):
+        return sum(find_collscans(value) for value in explain)
+    return 0